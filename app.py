@@ -4,15 +4,61 @@ import pandas as pd
 import numpy as np
 import folium
 from folium.plugins import Geocoder
-from streamlit_folium import folium_static
+from streamlit_folium import st_folium
+import streamlit.components.v1 as components
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+import csv
+import io
+import json
+import os
 import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
 from branca.colormap import linear
+from branca.element import Element, MacroElement
+from jinja2 import Template
 
 # --- 2. CONFIGURAZIONE CENTRALE E FUNZIONI DI BASE ---
-SHEET_URL = "https://docs.google.com/spreadsheets/d/e/2PACX-1vRxitMYpUqvX6bxVaukG01lJDC8SUfXtr47Zv5ekR1IzfR1jmhUilBsxZPJ8hrktVHrBh6hUUWYUtox/pub?output=csv"
+SHEET_URL = os.environ.get("SHEET_URL", "https://docs.google.com/spreadsheets/d/e/2PACX-1vRxitMYpUqvX6bxVaukG01lJDC8SUfXtr47Zv5ekR1IzfR1jmhUilBsxZPJ8hrktVHrBh6hUUWYUtox/pub?output=csv")
+# Archivio colonnare locale delle righe già tipizzate (chiave STAZIONE, DATA); va invalidato quando cambia la tipizzazione
+LOCAL_STORE_PATH = os.environ.get("LOCAL_STORE_PATH", "dati_storici.parquet")
+STORE_SCHEMA_VERSION = 7
+# Giorni tenuti nella coda dell'archivio (riscritta a ogni aggiornamento) prima di consolidarli nello storico
+STORE_TAIL_DAYS = 31
+# Memoria massima (byte occupati dalle stringhe HTML, vedi sys.getsizeof) della cache delle mappe già renderizzate
+MAP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Ogni quanto il thread in background ricontrolla lo sheet (richiesta condizionale ETag/Last-Modified)
+REFRESH_INTERVAL_SECONDS = int(os.environ.get("REFRESH_INTERVAL_SECONDS", 3600))
+# Finché non c'è nessuno snapshot (primo download fallito) si riprova dopo questi secondi, raddoppiando fino all'intervallo
+REFRESH_RETRY_SECONDS = int(os.environ.get("REFRESH_RETRY_SECONDS", 30))
+# Intervalli della panoramica min-max dei grafici di stazione fuori dalla finestra predefinita
+DECIMATION_BUCKETS = 150
+# plotly.js per i popup dell'analisi di periodo: "cdn" lo fa scaricare al browser dalla CDN di plotly e, se non arriva, dalla
+# copia inclusa in plotly servita dall'app in static/ (server.enableStaticServing); "inline" lo incorpora in ogni mappa
+PLOTLY_JS_MODE = os.environ.get("PLOTLY_JS_MODE", "cdn")
+PLOTLY_STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+# Mappe pre-renderizzate da prerender.py (job notturno): servite al posto del build quando i filtri sono ai valori predefiniti
+PRERENDER_DIR = os.environ.get("PRERENDER_DIR", "mappe_statiche")
+PRERENDER_PERIOD_DAYS = (1, 7, 30)
+MAP_TILES = ["OpenStreetMap", "Stamen Terrain", "CartoDB positron"]
+# Indice spaziale a griglia (gradi per cella) e modalità viewport: sotto VIEWPORT_MIN_ZOOM le stazioni sono raggruppate per cella
+SPATIAL_CELL_DEGREES = 0.25
+VIEWPORT_MIN_ZOOM = 9
+NEAREST_STATIONS = 10
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+# Sezione admin "Prestazioni" nella sidebar con i tempi per fase e l'export JSON
+PROFILING_PANEL = os.environ.get("PROFILING_PANEL", "0") == "1"
 
 COL_MAP_LEGACY = {
     "Stazione": "Legenda_Stazione", "DESCRIZIONE": "Legenda_DESCRIZIONE", "COMUNE": "Legenda_COMUNE", "ALTITUDINE": "Legenda_ALTITUDINE", "X": "Longitudine", "Y": "Latitudine",
@@ -30,6 +76,26 @@ COLONNE_FILTRO_RIEPILOGO = [
     "LEGENDA_MEDIA_PORCINI_CALDO_ST_MIGLIORE", "LEGENDA_MEDIA_PORCINI_FREDDO_ST_MIGLIORE",
     "LEGENDA_MEDIA_PORCINI_CALDO_ST_SECONDO", "LEGENDA_MEDIA_PORCINI_FREDDO_ST_SECONDO"
 ]
+# Slider della mappa riepilogativa per sezione della sidebar: (colonna dello stato attuale, etichetta). Un nuovo filtro
+# di intervallo si aggiunge qui, limiti e maschera li calcola get_filter_engine
+RIEPILOGO_FILTERS = {
+    "Filtri Dati Standard": [(col, f"Filtra per {col.replace('LEGENDA_', '').replace('_', ' ').title()}") for col in COLONNE_FILTRO_RIEPILOGO],
+    "Filtri Sbalzo Termico": [("LEGENDA_SBALZO_NUMERICO_MIGLIORE", "Sbalzo Termico Migliore"), ("LEGENDA_SBALZO_NUMERICO_SECONDO", "Sbalzo Termico Secondo")],
+}
+
+TEXT_COLUMNS = [
+    'STAZIONE', 'LEGENDA_DESCRIZIONE', 'LEGENDA_COMUNE', 'LEGENDA_COLORE', 'LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET', 
+    'LEGENDA_SBALZO_TERMICO_MIGLIORE', 'LEGENDA_SBALZO_TERMICO_SECONDO', 
+    'PORCINI_CALDO_NOTE', 'PORCINI_FREDDO_NOTE',
+    'SBALZO_TERMICO_MIGLIORE', '2°_SBALZO_TERMICO_MIGLIORE'
+]
+FLOAT64_COLUMNS = ['LATITUDINE', 'LONGITUDINE']
+# Colonne storiche degli sbalzi termici -> suffisso delle colonne derivate SBALZO_NUMERICO_* e SBALZO_DATA_*
+SBALZO_EVENT_COLUMNS = {'SBALZO_TERMICO_MIGLIORE': 'MIGLIORE', '2°_SBALZO_TERMICO_MIGLIORE': 'SECONDO'}
+# Colonne dello sheet che l'app non legge mai: scartate al caricamento
+DROPPED_COLUMNS = ['COORDINATEGOOGLE']
+# Colonne della tabella dello stato attuale oltre alle LEGENDA_*: identità, data e posizione della stazione
+LATEST_STATE_KEY_COLUMNS = ['STAZIONE', 'DATA', 'LATITUDINE', 'LONGITUDINE']
 
 def check_password():
     def password_entered():
@@ -44,111 +110,731 @@ def check_password():
 @st.cache_resource
 def get_view_counter(): return {"count": 0}
 
-@st.cache_data(ttl=3600)
-def load_and_prepare_data(url: str):
+@st.cache_resource
+def get_profiler(): return {"stadi": OrderedDict(), "lock": threading.Lock(), "avvii": 0, "attivi": {}}
+
+@contextmanager
+def profile_stage(nome, profiler=None):
+    # Tempo di ogni fase (download, parsing, filtri, marker, popup, grafici, serializzazione) accumulato tra le sessioni;
+    # il picco di memoria solo se tracemalloc è attivo (toggle nel pannello admin), perché rallenta molto le allocazioni.
+    # Il picco di tracemalloc è di tutto il processo: si attribuisce alla fase solo se all'inizio non c'erano fasi in corso
+    # in altri thread (altre sessioni, thread di aggiornamento) e nel frattempo non ne è iniziata nessun'altra
+    # Il thread di aggiornamento riceve il profiler dal chiamante: fuori dallo script niente cache_resource
+    profiler = profiler or get_profiler(); thread = threading.get_ident()
+    with profiler["lock"]:
+        profiler["avvii"] += 1; avvio = profiler["avvii"]
+        isolata = not any(attive for altro, attive in profiler["attivi"].items() if altro != thread)
+        profiler["attivi"][thread] = profiler["attivi"].get(thread, 0) + 1
+        memoria = tracemalloc.is_tracing()
+        if memoria: tracemalloc.reset_peak(); base = tracemalloc.get_traced_memory()[0]
+    inizio = time.perf_counter()
+    try: yield
+    finally:
+        durata = time.perf_counter() - inizio
+        with profiler["lock"]:
+            profiler["attivi"][thread] -= 1
+            if not profiler["attivi"][thread]: del profiler["attivi"][thread]
+            misurabile = memoria and isolata and profiler["avvii"] == avvio and tracemalloc.is_tracing()
+            picco = tracemalloc.get_traced_memory()[1] - base if misurabile else None
+            stadio = profiler["stadi"].setdefault(nome, {"chiamate": 0, "totale_s": 0.0, "ultimo_s": 0.0, "massimo_s": 0.0, "picco_memoria_byte": None})
+            stadio["chiamate"] += 1; stadio["totale_s"] += durata; stadio["ultimo_s"] = durata; stadio["massimo_s"] = max(stadio["massimo_s"], durata)
+            if picco is not None: stadio["picco_memoria_byte"] = max(stadio["picco_memoria_byte"] or 0, picco)
+
+NOTA_MEMORIA = ("picco_memoria_byte: picco di tracemalloc (memoria allocata da tutto il processo) durante la fase, "
+                "solo per le chiamate non sovrapposte ad altre fasi in corso")
+
+def profiler_report():
+    profiler = get_profiler()
+    with profiler["lock"]:
+        stadi = {nome: dict(valori, medio_s=valori["totale_s"] / valori["chiamate"]) for nome, valori in profiler["stadi"].items()}
+    return {"generato": datetime.now().strftime("%d/%m/%Y %H:%M:%S"), "memoria_misurata": tracemalloc.is_tracing(), "nota_memoria": NOTA_MEMORIA, "stadi": stadi}
+
+def display_profiler_panel(contenitore):
+    with contenitore.expander("⏱️ Prestazioni (admin)"):
+        memoria = st.toggle("Misura memoria (tracemalloc, rallenta l'app)", value=tracemalloc.is_tracing(), key="profiler_memoria")
+        if memoria and not tracemalloc.is_tracing(): tracemalloc.start()
+        elif not memoria and tracemalloc.is_tracing(): tracemalloc.stop()
+        report = profiler_report(); st.caption(NOTA_MEMORIA)
+        if report["stadi"]: st.dataframe(pd.DataFrame.from_dict(report["stadi"], orient="index")[["chiamate", "ultimo_s", "medio_s", "massimo_s", "picco_memoria_byte"]])
+        st.download_button("Esporta JSON", json.dumps(report, indent=2), file_name="prestazioni.json", mime="application/json")
+        if st.button("Azzera misure"):
+            profiler = get_profiler()
+            with profiler["lock"]: profiler["stadi"].clear()
+
+@st.cache_resource
+def get_map_cache(): return {"mappe": OrderedDict(), "byte": 0, "hits": 0, "misses": 0, "lock": threading.Lock()}
+
+def render_map_html(mappa):
+    with profile_stage("serializzazione mappa"): return folium.Figure().add_child(mappa).render()
+
+def render_map_cached(chiave, build_map):
+    # LRU condivisa tra le sessioni dell'HTML già serializzato: la chiave contiene versione dei dati, modalità, tile e filtri
+    cache = get_map_cache()
+    with cache["lock"]:
+        html = cache["mappe"].get(chiave)
+        if html is not None: cache["mappe"].move_to_end(chiave); cache["hits"] += 1; return html
+        cache["misses"] += 1
+    html = render_map_html(build_map())
+    with cache["lock"]:
+        if chiave not in cache["mappe"]: cache["mappe"][chiave] = html; cache["byte"] += sys.getsizeof(html)
+        while cache["byte"] > MAP_CACHE_MAX_BYTES and len(cache["mappe"]) > 1:
+            _, vecchia = cache["mappe"].popitem(last=False); cache["byte"] -= sys.getsizeof(vecchia)
+    return html
+
+def show_map_html(html, width=1000, height=700): components.html(html, height=height + 10, width=width)
+
+def prerender_name(tipo, tile, giorni=None):
+    # Nome del file di una mappa pre-renderizzata, es. riepilogo_openstreetmap.html o periodo_7gg_cartodb_positron.html
+    return f"{tipo}{f'_{giorni}gg' if giorni else ''}_{re.sub(r'[^a-z0-9]+', '_', tile.lower())}.html"
+
+def prerender_signature(df_stato):
+    # Identifica i dati da cui è stata generata una mappa statica: ultima DATA e timestamp di aggiornamento dello sheet
+    aggiornamento = df_stato['LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET'].iloc[0] if 'LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET' in df_stato.columns and not df_stato.empty else None
+    return f"{df_stato['DATA'].max():%Y-%m-%d} {'' if pd.isna(aggiornamento) else aggiornamento}".strip()
+
+def get_prerendered_map(nome, firma, prerender_dir=PRERENDER_DIR):
+    # HTML pre-renderizzato solo se il manifest si riferisce agli stessi dati; altrimenti None e la mappa si costruisce come sempre
     try:
-        df = pd.read_csv(url, na_values=["#N/D", "#N/A"], dtype=str, header=0, skiprows=[1])
-        df.attrs['last_loaded'] = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        if isinstance(df.columns, pd.MultiIndex): df.columns = ['_'.join(map(str, col)).strip() for col in df.columns.values]
-        cleaned_cols = {}
-        for col in df.columns:
-            # --- ECCO LA RIGA CORRETTA ---
-            cleaned_name = re.sub(r'\[.*?\]|\(.*?\)|\'', '', str(col)).strip().replace(' ', '_').upper()
-            if col.upper().startswith('LEGENDA_'):
-                base_name = re.sub(r'^LEGENDA_', '', cleaned_name)
-                cleaned_cols[col] = f"LEGENDA_{base_name}"
-            else:
-                cleaned_cols[col] = cleaned_name
-        df.rename(columns=cleaned_cols, inplace=True)
-        df = df.loc[:, ~df.columns.duplicated()]
-        for sbalzo_col, suffisso in [("LEGENDA_SBALZO_TERMICO_MIGLIORE", "MIGLIORE"), ("LEGENDA_SBALZO_TERMICO_SECONDO", "SECONDO")]:
-            if sbalzo_col in df.columns:
-                split_cols = df[sbalzo_col].str.split(' - ', n=1, expand=True)
-                if split_cols.shape[1] == 2:
-                    df[f"LEGENDA_SBALZO_NUMERICO_{suffisso}"] = pd.to_numeric(split_cols[0].str.replace(',', '.'), errors='coerce')
-        TEXT_COLUMNS = [
-            'STAZIONE', 'LEGENDA_DESCRIZIONE', 'LEGENDA_COMUNE', 'LEGENDA_COLORE', 'LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET', 
-            'LEGENDA_SBALZO_TERMICO_MIGLIORE', 'LEGENDA_SBALZO_TERMICO_SECONDO', 
-            'PORCINI_CALDO_NOTE', 'PORCINI_FREDDO_NOTE',
-            'SBALZO_TERMICO_MIGLIORE', '2°_SBALZO_TERMICO_MIGLIORE'
-        ]
-        for col in df.columns:
-            if col == 'DATA': df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True)
-            elif col not in TEXT_COLUMNS:
+        with open(os.path.join(prerender_dir, "manifest.json"), encoding="utf-8") as f: manifest = json.load(f)
+        if manifest.get("firma") != firma or nome not in manifest.get("mappe", []): return None
+        with open(os.path.join(prerender_dir, nome), encoding="utf-8") as f: return f.read()
+    except (OSError, ValueError): return None
+
+def normalize_range(valore, massimo):
+    # Slider a fondo scala => None, così le viste di default condividono la stessa chiave di cache
+    valore = (round(float(valore[0]), 4), round(float(valore[1]), 4))
+    return None if valore == (0.0, round(float(massimo), 4)) else valore
+
+def pulisci_nome(col):
+    # --- ECCO LA RIGA CORRETTA ---
+    cleaned_name = re.sub(r'\[.*?\]|\(.*?\)|\'', '', str(col)).strip().replace(' ', '_').upper()
+    if str(col).upper().startswith('LEGENDA_'): return f"LEGENDA_{re.sub(r'^LEGENDA_', '', cleaned_name)}"
+    return cleaned_name
+
+def tipo_colonna(col):
+    # Schema dichiarativo: DATA è una data, TEXT_COLUMNS è testo, tutto il resto è numerico. float32 basta per lo storico;
+    # coordinate e LEGENDA_* restano float64 (le LEGENDA_ vanno nei popup con due decimali e stanno solo nello stato attuale)
+    if col == 'DATA': return 'data'
+    if col in TEXT_COLUMNS: return 'testo'
+    return 'float64' if col in FLOAT64_COLUMNS or col.startswith('LEGENDA_') else 'float32'
+
+def scarica_sorgente(source, etag=None, last_modified=None):
+    # Richiesta condizionale: restituisce (None, etag, last_modified) se lo sheet non è cambiato dall'ultima volta
+    if re.match(r'^https?://', str(source)):
+        richiesta = urllib.request.Request(source)
+        if etag: richiesta.add_header("If-None-Match", etag)
+        if last_modified: richiesta.add_header("If-Modified-Since", last_modified)
+        try:
+            with urllib.request.urlopen(richiesta, timeout=60) as risposta: return risposta.read(), risposta.headers.get("ETag"), risposta.headers.get("Last-Modified")
+        except urllib.error.HTTPError as e:
+            if e.code == 304: return None, etag, last_modified
+            raise
+    # File locale: la data di modifica fa da Last-Modified
+    modificato = str(os.path.getmtime(source))
+    if modificato == last_modified: return None, etag, last_modified
+    with open(source, 'rb') as f: return f.read(), None, modificato
+
+def leggi_sorgente(source): return scarica_sorgente(source)[0]
+
+def converti_date(serie, formato=None):
+    # Le date si ripetono per ogni stazione: si convertono solo i valori distinti e si ridistribuiscono con i codici
+    codici, uniche = pd.factorize(serie)
+    opzioni = dict(format=formato) if formato else dict(dayfirst=True)
+    date = pd.to_datetime(pd.Series(uniche, dtype=object), errors='coerce', **opzioni).to_numpy()
+    # NaT in coda: i valori mancanti (codice -1) lo prendono direttamente, anche se la colonna è tutta vuota
+    date = np.append(date, np.array(['NaT'], dtype=date.dtype))
+    return pd.Series(date[codici], index=serie.index)
+
+def righe_dal(data, dal):
+    # Sottoinsieme del CSV con intestazione, riga delle unità e solo le righe con DATA >= dal, senza tokenizzare tutto il
+    # file: per ogni riga si isola il solo campo DATA e si convertono le date distinte
+    righe = data.split(b'\n')
+    nomi = [pulisci_nome(col) for col in next(csv.reader([righe[0].decode('utf-8-sig').strip('\r')]))]
+    k = nomi.index('DATA'); campo_data = re.compile(rb'(?:[^,"]*,){%d}([^,]*)' % k)
+    def campo_con_virgolette(riga):
+        valori = next(csv.reader([riga.decode('utf-8', 'replace')]), [])
+        return valori[k].encode() if len(valori) > k else b''
+    # Di norma i campi prima di DATA non hanno virgolette e basta la regex; altrimenti si passa dal modulo csv
+    valori = [m.group(1) if (m := campo_data.match(riga)) else campo_con_virgolette(riga) for riga in righe[2:]]
+    date = converti_date(pd.Series(valori, dtype=object).str.decode('utf-8', 'replace').str.strip().str.strip('"'))
+    blocchi = []
+    for i in (np.flatnonzero((date >= dal).to_numpy()) + 2).tolist():
+        # Numero dispari di virgolette: la riga continua nelle successive (a capo dentro un campo tra virgolette)
+        j = i
+        while sum(r.count(b'"') for r in righe[i:j + 1]) % 2 and j + 1 < len(righe): j += 1
+        blocchi.append(b'\n'.join(righe[i:j + 1]))
+    return b'\n'.join(righe[:2] + blocchi) + b'\n'
+
+def leggi_csv(data, dal=None):
+    # dal: solo le righe con DATA >= dal (aggiornamento incrementale dell'archivio), vedi righe_dal
+    if dal is not None: data = righe_dal(data, dal)
+    opzioni = dict(na_values=["#N/D", "#N/A"], header=0, skiprows=[1])
+    nomi = {col: pulisci_nome(col) for col in pd.read_csv(io.BytesIO(data), nrows=0, **opzioni).columns}
+    dtype = {col: str for col, nome in nomi.items() if tipo_colonna(nome) in ('data', 'testo')}
+    # Un solo passaggio del parser C: le colonne numeriche arrivano già convertite con la virgola decimale
+    df = pd.read_csv(io.BytesIO(data), dtype=dtype, decimal=',', **opzioni).rename(columns=nomi)
+    df = df.loc[:, ~df.columns.duplicated()]
+    for col in df.columns:
+        tipo = tipo_colonna(col)
+        if tipo == 'data': df[col] = converti_date(df[col])
+        elif tipo != 'testo':
+            if not pd.api.types.is_numeric_dtype(df[col]) or pd.api.types.is_bool_dtype(df[col]):
+                # Colonne con valori sporchi o col punto decimale: solo queste passano dalla conversione testuale
                 df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '.', regex=False), errors='coerce')
-        df.dropna(subset=['LONGITUDINE', 'LATITUDINE', 'DATA'], inplace=True, how='any')
-        return df
-    except Exception as e:
-        st.error(f"Errore critico durante il caricamento dei dati: {e}"); return None
+            df[col] = df[col].astype(tipo)
+    return df
+
+def prepara_righe(df):
+    for sbalzo_col, suffisso in [("LEGENDA_SBALZO_TERMICO_MIGLIORE", "MIGLIORE"), ("LEGENDA_SBALZO_TERMICO_SECONDO", "SECONDO")]:
+        if sbalzo_col in df.columns:
+            split_cols = df[sbalzo_col].str.split(' - ', n=1, expand=True)
+            if split_cols.shape[1] == 2:
+                df[f"LEGENDA_SBALZO_NUMERICO_{suffisso}"] = pd.to_numeric(split_cols[0].str.replace(',', '.'), errors='coerce')
+    # Sbalzi storici "valore - gg/mm/aaaa": valore numerico e data dell'evento separati una volta sola al caricamento
+    for sbalzo_col, suffisso in SBALZO_EVENT_COLUMNS.items():
+        if sbalzo_col in df.columns:
+            parti = df[sbalzo_col].str.extract(r'^(.*?) - (.*)$')
+            df[f"SBALZO_NUMERICO_{suffisso}"] = pd.to_numeric(parti[0].str.strip().str.replace(',', '.', regex=False), errors='coerce').astype('float32')
+            df[f"SBALZO_DATA_{suffisso}"] = converti_date(parti[1].str.strip(), formato="%d/%m/%Y")
+    df.dropna(subset=['STAZIONE', 'LONGITUDINE', 'LATITUDINE', 'DATA'], inplace=True, how='any')
+    return df
+
+def compatta_testo(df):
+    # Nello storico il testo ripetuto diventa categoria
+    for col in df.columns:
+        if col in TEXT_COLUMNS and not isinstance(df[col].dtype, pd.CategoricalDtype): df[col] = df[col].astype('category')
+    return df
+
+def ordina_per_stazione(df):
+    # Ordinamento per (STAZIONE, DATA) sul testo della stazione, anche se è una categoria: ogni stazione è un blocco contiguo
+    return df.sort_values(['STAZIONE', 'DATA'], kind='stable', key=lambda serie: serie.astype(str) if serie.name == 'STAZIONE' else serie).reset_index(drop=True)
+
+def separa_stato_attuale(df):
+    # Le LEGENDA_* sono lette solo all'ultima data (mappa riepilogativa): vanno in una tabella con una riga per stazione
+    # invece di ripetersi su ogni giorno di storia
+    colonne_legenda = [col for col in df.columns if col.startswith('LEGENDA_')]
+    stato = df.loc[df['DATA'] == df['DATA'].max(), [col for col in LATEST_STATE_KEY_COLUMNS if col in df.columns] + colonne_legenda].reset_index(drop=True)
+    return compatta_testo(df.drop(columns=colonne_legenda + [col for col in DROPPED_COLUMNS if col in df.columns])), stato
+
+def unisci_ordinato(base, coda):
+    # base e coda sono ordinate per (STAZIONE, DATA) e ogni data della coda è successiva a quelle della base: ogni riga della
+    # coda va in fondo al blocco della sua stazione, quindi basta inserire per posizione invece di riordinare tutto
+    if coda.empty: return base
+    if base.empty: return coda.reset_index(drop=True)
+    codici, nomi = pd.factorize(base['STAZIONE'])
+    fini = np.r_[np.flatnonzero(np.diff(codici)) + 1, len(codici)]
+    nomi_blocchi = np.asarray(nomi, dtype=object)[codici[fini - 1]]
+    posizioni = np.r_[0, fini][np.searchsorted(nomi_blocchi, coda['STAZIONE'].astype(object).to_numpy(), side='right')]
+    base = base.copy(deep=False); coda = coda.copy(deep=False)
+    for col in base.columns:
+        # Categorie della base seguite da quelle nuove della coda: i codici della base restano validi e la colonna resta categoria
+        if isinstance(base[col].dtype, pd.CategoricalDtype) and col in coda.columns:
+            categorie = base[col].cat.categories.union(pd.Index(coda[col].dropna().astype(object).unique()), sort=False)
+            base[col] = base[col].cat.set_categories(categorie); coda[col] = coda[col].astype(object).astype(pd.CategoricalDtype(categorie))
+    ordine = np.insert(np.arange(len(base)), posizioni, np.arange(len(base), len(base) + len(coda)))
+    return pd.concat([base, coda], ignore_index=True).take(ordine).reset_index(drop=True)
+
+def percorso_parte(store_path, parte):
+    radice, estensione = os.path.splitext(store_path)
+    return f"{radice}_{parte}{estensione}"
+
+def leggi_parti(store_path):
+    # Archivio in tre file: storico consolidato (store_path), coda degli ultimi giorni (_coda) e stato attuale (_stato).
+    # Se manca un file, è illeggibile, di uno schema vecchio o i file non sono coerenti tra loro si riparte da zero
+    percorsi = [store_path, percorso_parte(store_path, "coda"), percorso_parte(store_path, "stato")] if store_path else []
+    if not percorsi or not all(os.path.exists(p) for p in percorsi): return None
+    try: base, coda, stato = (pd.read_parquet(p) for p in percorsi)
+    except Exception: return None
+    if any(df.attrs.get('schema') != STORE_SCHEMA_VERSION for df in (base, coda, stato)): return None
+    if coda.empty or stato.empty or stato['DATA'].max() != coda['DATA'].max(): return None
+    if not base.empty and base['DATA'].max() >= coda['DATA'].min(): return None
+    return base, coda, stato
+
+def leggi_archivio(store_path):
+    parti = leggi_parti(store_path)
+    return None if parti is None else (unisci_ordinato(parti[0], parti[1]), parti[2])
+
+def salva_archivio(store_path, coda, stato, base=None):
+    # Di norma si riscrivono solo coda e stato; lo storico consolidato (base) solo quando cambia. Si scrive nell'ordine
+    # storico, coda, stato: un'interruzione a metà lascia file incoerenti che leggi_parti scarta. I file temporanei hanno
+    # nomi univoci, così due processi che salvano insieme (app e prerender) non si sovrascrivono il file a metà
+    if not store_path: return
+    try:
+        for df, path in [(base, store_path), (coda, percorso_parte(store_path, "coda")), (stato, percorso_parte(store_path, "stato"))]:
+            if df is None: continue
+            df.attrs['schema'] = STORE_SCHEMA_VERSION
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=f"{os.path.basename(path)}.", suffix=".tmp"); os.close(fd)
+            os.chmod(tmp_path, 0o644)  # mkstemp crea il file leggibile solo dal proprietario
+            try: df.to_parquet(tmp_path, index=False); os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+    except Exception as e: st.warning(f"Impossibile aggiornare l'archivio locale: {e}")
+
+def aggiorna_archivio(data, store_path=LOCAL_STORE_PATH, profiler=None, sola_lettura=False):
+    # Si tipizzano solo le righe dall'ultima DATA archiviata in poi (l'ultimo giorno viene riletto perché al refresh
+    # precedente poteva essere ancora incompleto) e si accodano allo storico già ordinato, senza riordinarlo né riscriverlo.
+    # sola_lettura: l'archivio si usa ma non si aggiorna (processi esterni all'app, come prerender.py)
+    with profile_stage("archivio parquet", profiler): parti = leggi_parti(store_path)
+    with profile_stage("parsing CSV", profiler):
+        if parti is None:
+            storico, stato = separa_stato_attuale(ordina_per_stazione(prepara_righe(leggi_csv(data)).drop_duplicates(subset=['STAZIONE', 'DATA'], keep='last')))
+            ultima_data = storico['DATA'].max(); base_da_scrivere = storico[storico['DATA'] < ultima_data].reset_index(drop=True)
+            coda = storico[storico['DATA'] == ultima_data].reset_index(drop=True)
+        else:
+            base, coda, stato = parti; ultima_data = coda['DATA'].max(); base_da_scrivere = None
+            nuove = prepara_righe(leggi_csv(data, dal=ultima_data)); nuove = nuove[nuove['DATA'] >= ultima_data]
+            if nuove.empty: return unisci_ordinato(base, coda), stato
+            righe_nuove, stato = separa_stato_attuale(ordina_per_stazione(nuove.drop_duplicates(subset=['STAZIONE', 'DATA'], keep='last')))
+            coda = pd.concat([coda[coda['DATA'] < ultima_data].astype({'STAZIONE': object}), righe_nuove.astype({'STAZIONE': object})], ignore_index=True)
+            coda = compatta_testo(ordina_per_stazione(coda))
+            if coda['DATA'].nunique() > STORE_TAIL_DAYS:
+                # Consolidamento: i giorni della coda tranne l'ultimo passano nello storico, che solo ora viene riscritto
+                ultima_data = coda['DATA'].max(); base = base_da_scrivere = unisci_ordinato(base, coda[coda['DATA'] < ultima_data])
+                coda = coda[coda['DATA'] == ultima_data].reset_index(drop=True)
+            storico = unisci_ordinato(base, coda)
+    if not sola_lettura:
+        with profile_stage("archivio parquet", profiler): salva_archivio(store_path, coda, stato, base_da_scrivere)
+    return storico, stato
+
+class SheetRefresher:
+    # Stale-while-revalidate: gli utenti ricevono sempre l'ultimo snapshot valido, senza attese di rete; un thread in
+    # background riscarica lo sheet con richieste condizionali e sostituisce lo snapshot solo a elaborazione conclusa
+
+    def __init__(self, source, store_path=LOCAL_STORE_PATH, intervallo=REFRESH_INTERVAL_SECONDS, profiler=None, ritento=REFRESH_RETRY_SECONDS):
+        self.source = source; self.store_path = store_path; self.intervallo = intervallo; self.profiler = profiler; self.ritento = ritento
+        self.snapshot = None; self.etag = None; self.last_modified = None; self.ultimo_errore = None
+        self._lock = threading.Lock(); self._stop = threading.Event(); self._thread = None
+
+    def get(self): return self.snapshot  # (storico, stato attuale) oppure None
+
+    def refresh(self):
+        # True se è stato pubblicato un nuovo snapshot, False se lo sheet non è cambiato (304)
+        with self._lock:
+            try:
+                with profile_stage("download sheet", self.profiler): data, etag, last_modified = scarica_sorgente(self.source, self.etag, self.last_modified)
+                if data is None: self.ultimo_errore = None; return False
+                dati = aggiorna_archivio(data, self.store_path, self.profiler)
+                dati[0].attrs['last_loaded'] = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+                self.snapshot = dati; self.etag = etag; self.last_modified = last_modified; self.ultimo_errore = None
+                return True
+            except Exception as e:
+                self.ultimo_errore = f"{datetime.now().strftime('%d/%m/%Y %H:%M:%S')}: {e}"; return False
+
+    def start(self):
+        # Primo snapshot: l'archivio locale se c'è (nessuna attesa, il thread lo aggiorna subito), altrimenti un download sincrono
+        archivio = leggi_archivio(self.store_path)
+        if archivio is not None:
+            archivio[0].attrs['last_loaded'] = datetime.fromtimestamp(os.path.getmtime(percorso_parte(self.store_path, "stato"))).strftime("%d/%m/%Y %H:%M:%S"); self.snapshot = archivio
+            attesa_iniziale = 0
+        else:
+            self.refresh(); attesa_iniziale = self.prossima_attesa(0)
+        self._thread = threading.Thread(target=self._ciclo, args=(attesa_iniziale,), name="sheet-refresher", daemon=True); self._thread.start()
+        return self
+
+    def stop(self): self._stop.set()
+
+    def prossima_attesa(self, attesa):
+        # Con uno snapshot valido si aspetta l'intervallo normale; senza, backoff breve per non lasciare l'app vuota per un'ora
+        if self.snapshot is not None: return self.intervallo
+        return min(max(attesa * 2, self.ritento), self.intervallo)
+
+    def _ciclo(self, attesa):
+        while not self._stop.wait(attesa):
+            self.refresh(); attesa = self.prossima_attesa(attesa)
+
+@st.cache_resource(on_release=lambda refresher: refresher.stop())  # svuotando la cache il thread precedente si ferma
+def get_data_refresher(source, store_path=LOCAL_STORE_PATH): return SheetRefresher(source, store_path, profiler=get_profiler()).start()
+
+@st.cache_resource(max_entries=4)
+def get_station_index(data_version, n_righe, _df):
+    # Offset [inizio, fine) del blocco di ogni stazione nel frame ordinato per (STAZIONE, DATA), calcolati una volta per caricamento
+    codici, nomi = pd.factorize(_df['STAZIONE'])
+    bordi = np.flatnonzero(np.diff(codici)) + 1; inizi = np.r_[0, bordi].astype(int); fini = np.r_[bordi, len(codici)].astype(int)
+    if len(inizi) != len(nomi) + int((codici < 0).any()): return None  # frame non ordinato per stazione
+    return {nomi[c]: (i, f) for c, i, f in zip(codici[inizi], inizi.tolist(), fini.tolist()) if c >= 0}
+
+def get_station_history(df, station_name):
+    indice = get_station_index(df.attrs['last_loaded'], len(df), df)
+    if indice is None: return df[df['STAZIONE'] == station_name].sort_values('DATA')
+    inizio, fine = indice.get(station_name, (0, 0))
+    return df.iloc[inizio:fine]
+
+# Campi additivi del cubo di periodo: nome della colonna aggregata -> valore giornaliero per riga
+PERIOD_CUBE_FIELDS = {
+    'TOTALE_PIOGGIA_GIORNO': lambda df: df['TOTALE_PIOGGIA_GIORNO'].fillna(0).to_numpy(dtype='float64'),
+    'GIORNI_DI_PIOGGIA': lambda df: (df['TOTALE_PIOGGIA_GIORNO'].fillna(0) > 0).to_numpy(dtype='float64'),
+}
+
+@st.cache_resource(max_entries=4)
+def get_period_cube(data_version, n_righe, _df):
+    # Matrice stazione x giorno delle somme cumulate (colonna 0 = zero): la somma su [i, j] è cum[:, j + 1] - cum[:, i]
+    codici, stazioni = pd.factorize(_df['STAZIONE']); prima_data = _df['DATA'].min().normalize()
+    giorni = ((_df['DATA'].dt.normalize() - prima_data) // pd.Timedelta(days=1)).to_numpy(dtype='int64'); validi = codici >= 0
+    cumulate = {}
+    for campo, valori_giornalieri in PERIOD_CUBE_FIELDS.items():
+        matrice = np.zeros((len(stazioni), int(giorni.max()) + 2))
+        np.add.at(matrice, (codici[validi], giorni[validi] + 1), valori_giornalieri(_df)[validi])
+        cumulate[campo] = np.cumsum(matrice, axis=1)
+    # Coordinate dall'ultima riga di ogni stazione
+    ultime = _df[validi].drop_duplicates('STAZIONE', keep='last').set_index('STAZIONE').reindex(stazioni)
+    return {"stazioni": np.asarray(stazioni), "prima_data": prima_data.date(), "ultima_data": _df['DATA'].max().date(), "cumulate": cumulate,
+            "LATITUDINE": ultime['LATITUDINE'].to_numpy(), "LONGITUDINE": ultime['LONGITUDINE'].to_numpy()}
+
+def aggregate_period(cubo, start_date, end_date):
+    n_colonne = next(iter(cubo["cumulate"].values())).shape[1]
+    inizio = min(max((start_date - cubo["prima_data"]).days, 0), n_colonne - 1); fine = min(max((end_date - cubo["prima_data"]).days + 1, 0), n_colonne - 1)
+    df_agg = pd.DataFrame({'STAZIONE': cubo["stazioni"]})
+    for campo, cumulata in cubo["cumulate"].items(): df_agg[campo] = cumulata[:, fine] - cumulata[:, inizio] if fine > inizio else 0.0
+    df_agg['LATITUDINE'], df_agg['LONGITUDINE'] = cubo["LATITUDINE"], cubo["LONGITUDINE"]
+    return df_agg
+
+@st.cache_resource(max_entries=4)
+def get_spatial_index(data_version, n_righe, _df_stato):
+    # Griglia di celle da SPATIAL_CELL_DEGREES gradi: cella (riga, colonna) -> posizioni delle stazioni nello stato attuale.
+    # Come nei marker: nello sheet LONGITUDINE contiene la latitudine e LATITUDINE la longitudine
+    lat = pd.to_numeric(_df_stato['LONGITUDINE'], errors='coerce').to_numpy(dtype='float64'); lon = pd.to_numeric(_df_stato['LATITUDINE'], errors='coerce').to_numpy(dtype='float64')
+    valide = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+    righe = np.floor(lat[valide] / SPATIAL_CELL_DEGREES).astype('int64'); colonne = np.floor(lon[valide] / SPATIAL_CELL_DEGREES).astype('int64')
+    ordine = np.lexsort((colonne, righe)); righe, colonne, posizioni = righe[ordine], colonne[ordine], valide[ordine]
+    bordi = np.flatnonzero((np.diff(righe) != 0) | (np.diff(colonne) != 0)) + 1; inizi = np.r_[0, bordi].astype(int); fini = np.r_[bordi, len(posizioni)].astype(int)
+    celle = {(int(righe[i]), int(colonne[i])): posizioni[i:f] for i, f in zip(inizi.tolist(), fini.tolist())} if len(posizioni) else {}
+    return {"lat": lat, "lon": lon, "celle": celle}
+
+def query_bounds(indice, sud, ovest, nord, est):
+    # Posizioni (ordinate) delle stazioni nel rettangolo: si visitano solo le celle che lo intersecano
+    r0, r1 = int(np.floor(sud / SPATIAL_CELL_DEGREES)), int(np.floor(nord / SPATIAL_CELL_DEGREES)); c0, c1 = int(np.floor(ovest / SPATIAL_CELL_DEGREES)), int(np.floor(est / SPATIAL_CELL_DEGREES))
+    if (r1 - r0 + 1) * (c1 - c0 + 1) > len(indice["celle"]): chiavi = [k for k in indice["celle"] if r0 <= k[0] <= r1 and c0 <= k[1] <= c1]
+    else: chiavi = [(r, c) for r in range(r0, r1 + 1) for c in range(c0, c1 + 1) if (r, c) in indice["celle"]]
+    if not chiavi: return np.array([], dtype=int)
+    candidati = np.concatenate([indice["celle"][k] for k in chiavi]); lat, lon = indice["lat"][candidati], indice["lon"][candidati]
+    return np.sort(candidati[(lat >= sud) & (lat <= nord) & (lon >= ovest) & (lon <= est)])
+
+def distance_km(lat, lon, lat_stazioni, lon_stazioni):
+    # Distanza haversine su sfera di raggio 6371 km
+    phi1, phi2 = np.radians(lat), np.radians(lat_stazioni); dphi, dlambda = phi2 - phi1, np.radians(lon_stazioni - lon)
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2))
+
+def query_radius(indice, lat, lon, raggio_km):
+    # Stazioni entro raggio_km, più vicine per prime: (posizioni, distanze in km)
+    dlat = raggio_km / 111.0; dlon = min(raggio_km / (111.0 * max(np.cos(np.radians(lat)), 1e-6)), 180.0)
+    candidati = query_bounds(indice, lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+    distanze = distance_km(lat, lon, indice["lat"][candidati], indice["lon"][candidati]); dentro = distanze <= raggio_km
+    ordine = np.argsort(distanze[dentro], kind='stable')
+    return candidati[dentro][ordine], distanze[dentro][ordine]
+
+def query_nearest(indice, lat, lon, k=NEAREST_STATIONS):
+    # Raggio che raddoppia partendo da una cella finché non si trovano k stazioni (o si copre tutta la Terra)
+    raggio = SPATIAL_CELL_DEGREES * 111.0
+    while True:
+        posizioni, distanze = query_radius(indice, lat, lon, raggio)
+        if len(posizioni) >= k or raggio > 20040: return posizioni[:k], distanze[:k]
+        raggio *= 2
+
+def cluster_stations(indice, posizioni):
+    # Un gruppo per cella della griglia con le stazioni indicate: (lat media, lon media, numero di stazioni)
+    posizioni = posizioni[np.isfinite(indice["lat"][posizioni]) & np.isfinite(indice["lon"][posizioni])]
+    if not len(posizioni): return []
+    lat, lon = indice["lat"][posizioni], indice["lon"][posizioni]
+    _, gruppo, conteggi = np.unique(np.stack([np.floor(lat / SPATIAL_CELL_DEGREES), np.floor(lon / SPATIAL_CELL_DEGREES)], axis=1), axis=0, return_inverse=True, return_counts=True)
+    gruppo = gruppo.ravel()
+    return list(zip((np.bincount(gruppo, lat) / conteggi).tolist(), (np.bincount(gruppo, lon) / conteggi).tolist(), conteggi.tolist()))
+
+def parse_coordinates(testo):
+    # "43.77, 11.25" oppure "43,77 11,25" -> (lat, lon, testo); None se non sono coordinate valide
+    numeri = re.findall(r'-?\d+(?:[.,]\d+)?', testo)
+    if len(numeri) != 2 or re.sub(r'[-\d.,\s;]', '', testo): return None
+    lat, lon = (float(n.replace(',', '.')) for n in numeri)
+    return (lat, lon, f"{lat:.4f}, {lon:.4f}") if -90 <= lat <= 90 and -180 <= lon <= 180 else None
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def geocode_place(luogo):
+    # Geocoding con Nominatim (OpenStreetMap), limitato all'Italia: (lat, lon, nome) oppure None
+    url = f"{NOMINATIM_URL}?{urllib.parse.urlencode({'q': luogo, 'format': 'json', 'limit': 1, 'countrycodes': 'it'})}"
+    richiesta = urllib.request.Request(url, headers={"User-Agent": "mappa-analisi-piogge/1.0"})
+    try:
+        with urllib.request.urlopen(richiesta, timeout=10) as risposta: risultati = json.loads(risposta.read().decode("utf-8"))
+    except (OSError, ValueError): return None
+    if not risultati: return None
+    lat, lon = float(risultati[0]["lat"]), float(risultati[0]["lon"])
+    return lat, lon, f"{risultati[0].get('display_name', luogo)} ({lat:.4f}, {lon:.4f})"
 
 def create_map(tile, location=[43.8, 11.0], zoom=8):
     if "Stamen" in tile:
         return folium.Map(location=location, zoom_start=zoom, tiles=tile, attr='&copy; <a href="https://www.stadiamaps.com/" target="_blank">Stadia Maps</a> &copy; <a href="https://openmaptiles.org/" target="_blank">OpenMapTiles</a> &copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors')
     return folium.Map(location=location, zoom_start=zoom, tiles=tile)
 
-def display_main_map(df):
+POPUP_CSS = """<style>.popup-container{font-family:Arial,sans-serif;font-size:13px;max-height:350px;overflow-y:auto;overflow-x:hidden}h4{margin-top:12px;margin-bottom:5px;color:#0057e7;border-bottom:1px solid #ccc;padding-bottom:3px}table{width:100%;border-collapse:collapse;margin-bottom:10px}td{text-align:left;padding:4px;border-bottom:1px solid #eee}td:first-child{font-weight:bold;color:#333;width:65%}td:last-child{color:#555}.btn-container{text-align:center;margin-top:15px;}.btn{background-color:#007bff;color:white;padding:8px 12px;border-radius:5px;text-decoration:none;font-weight:bold;}</style>"""
+
+POPUP_GROUPS = { 
+    "Info Stazione": ["STAZIONE", "LEGENDA_DESCRIZIONE", "LEGENDA_COMUNE", "LEGENDA_ALTITUDINE"], 
+    "Dati Meteo": ["LEGENDA_TEMPERATURA_MEDIANA_MINIMA", "LEGENDA_TEMPERATURA_MEDIANA", "LEGENDA_UMIDITA_MEDIA_7GG", "LEGENDA_PIOGGE_RESIDUA", "LEGENDA_TOTALE_PIOGGE_MENSILI"], 
+    "Analisi Base": ["LEGENDA_MEDIA_PORCINI_CALDO_BASE", "LEGENDA_MEDIA_PORCINI_CALDO_BOOST", "LEGENDA_DURATA_RANGE_CALDO", "LEGENDA_CONTEGGIO_GG_ALLA_RACCOLTA_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_BASE", "LEGENDA_MEDIA_PORCINI_FREDDO_BOOST", "LEGENDA_DURATA_RANGE_FREDDO", "LEGENDA_CONTEGGIO_GG_ALLA_RACCOLTA_FREDDO"], 
+    "Analisi Sbalzo Migliore": ["LEGENDA_SBALZO_TERMICO_MIGLIORE", "LEGENDA_MEDIA_PORCINI_CALDO_ST_MIGLIORE", "LEGENDA_MEDIA_BOOST_CALDO_ST_MIGLIORE", "LEGENDA_GG_ST_MIGLIORE_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_ST_MIGLIORE", "LEGENDA_MEDIA_BOOST_FREDDO_ST_MIGLIORE", "LEGENDA_GG_ST_MIGLIORE_FREDDO"], 
+    "Analisi Sbalzo Secondo": ["LEGENDA_SBALZO_TERMICO_SECONDO", "LEGENDA_MEDIA_PORCINI_CALDO_ST_SECONDO", "LEGENDA_MEDIA_BOOST_CALDO_ST_SECONDO", "LEGENDA_GG_ST_SECONDO_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_ST_SECONDO", "LEGENDA_MEDIA_BOOST_FREDDO_ST_SECONDO", "LEGENDA_GG_ST_SECONDO_FREDDO"] 
+}
+
+def get_marker_color(val): return {"ROSSO": "red", "GIALLO": "yellow", "ARANCIONE": "orange", "VERDE": "green"}.get(str(val).strip().upper(), "gray")
+
+def format_popup_values(serie):
+    # Una colonna del popup in un solo passaggio: numeri all'italiana (1.234,56), testo così com'è, celle vuote a NaN
+    if pd.api.types.is_numeric_dtype(serie):
+        testo = pd.Series(np.char.mod('%.2f', serie.to_numpy(dtype='float64', na_value=np.nan)), index=serie.index, dtype='str')
+        testo = testo.str.replace('.', ',', regex=False)
+        # Separatore delle migliaia un gruppo di tre cifre alla volta (regex senza lookahead, eseguita dal motore di pyarrow)
+        while testo.str.contains(r'^-?\d{4}', regex=True, na=False).any(): testo = testo.str.replace(r'^(-?\d+)(\d{3})', r'\1.\2', regex=True)
+        return testo.where(serie.notna())
+    testo = serie.astype('str')
+    return testo.where(serie.notna() & (testo.str.strip() != ''))
+
+def build_popup_html(df_mappa):
+    # HTML dei popup per tutte le stazioni, colonna per colonna: etichette calcolate una volta, celle vuote mascherate
+    html = pd.Series(POPUP_CSS + '<div class="popup-container">', index=df_mappa.index, dtype='str')
+    for title, columns in POPUP_GROUPS.items():
+        righe = pd.Series('', index=df_mappa.index, dtype='str')
+        for col_name_actual in columns:
+            if col_name_actual not in df_mappa.columns: continue
+            col_name_label = col_name_actual.replace('LEGENDA_', '').replace('_', ' ').title()
+            righe = righe + (f"<tr><td>{col_name_label}</td><td>" + format_popup_values(df_mappa[col_name_actual]) + "</td></tr>").fillna('')
+        html = html + (f"<h4>{title}</h4><table>" + righe + "</table>").where(righe != '', '')
+    link = '?station=' + df_mappa['STAZIONE'].astype('str').fillna('nan')
+    return html + '<div class="btn-container"><a href="' + link + '" target="_self" class="btn">📈 Mostra Storico Stazione</a></div></div>'
+
+def add_classic_markers(mappa, df_mappa):
+    latitudini = pd.to_numeric(df_mappa['LONGITUDINE'], errors='coerce').tolist(); longitudini = pd.to_numeric(df_mappa['LATITUDINE'], errors='coerce').tolist()
+    colori = df_mappa['LEGENDA_COLORE'].map(get_marker_color).tolist() if 'LEGENDA_COLORE' in df_mappa.columns else ["gray"] * len(df_mappa)
+    with profile_stage("popup HTML"): popups = build_popup_html(df_mappa).tolist()
+    with profile_stage("marker"):
+        for lat, lon, colore, popup_html in zip(latitudini, longitudini, colori, popups):
+            if not (np.isfinite(lat) and np.isfinite(lon)): continue
+            folium.CircleMarker(location=[lat, lon], radius=6, color=colore, fill=True, fill_color=colore, fill_opacity=0.9, popup=folium.Popup(popup_html, max_width=380)).add_to(mappa)
+
+class StationLayer(MacroElement):
+    # Tutte le stazioni in un'unica FeatureCollection GeoJSON disegnata su canvas: il CSS del popup è emesso una
+    # sola volta e l'HTML del popup viene costruito dal browser solo all'apertura, a partire dalle proprietà compatte
+    _template = Template("""
+        {% macro header(this, kwargs) %}{{ this.css }}{% endmacro %}
+        {% macro script(this, kwargs) %}
+        (function() {
+            var gruppi = {{ this.gruppi|tojson }};
+            function formatta(v) {
+                if (typeof v !== "number") return v;
+                var parti = Math.abs(v).toFixed(2).split(".");
+                return (v < 0 ? "-" : "") + parti[0].replace(/\\B(?=(\\d{3})+(?!\\d))/g, ".") + "," + parti[1];
+            }
+            function popupStazione(p) {
+                var html = '<div class="popup-container">', i = 0;
+                gruppi.forEach(function(g) {
+                    var righe = "";
+                    g[1].forEach(function(etichetta) { var v = p.v[i++]; if (v !== null) righe += "<tr><td>" + etichetta + "</td><td>" + formatta(v) + "</td></tr>"; });
+                    if (righe) html += "<h4>" + g[0] + "</h4><table>" + righe + "</table>";
+                });
+                return html + '<div class="btn-container"><a href="?station=' + encodeURIComponent(p.s) + '" target="_self" class="btn">📈 Mostra Storico Stazione</a></div></div>';
+            }
+            var renderer = L.canvas();
+            L.geoJSON({{ this.dati|tojson }}, {
+                pointToLayer: function(f, latlng) { return L.circleMarker(latlng, {renderer: renderer, radius: 6, color: f.properties.c, fill: true, fillColor: f.properties.c, fillOpacity: 0.9}); },
+                onEachFeature: function(f, layer) { layer.bindPopup(function() { return popupStazione(f.properties); }, {maxWidth: 380}); }
+            }).addTo({{ this._parent.get_name() }});
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, dati, gruppi):
+        super().__init__()
+        self._name = "StationLayer"; self.dati = dati; self.gruppi = gruppi; self.css = POPUP_CSS
+
+def build_station_features(df_mappa):
+    # Colonne del popup presenti nel frame, nell'ordine dei gruppi; i valori vuoti diventano null e i numeri sono arrotondati al centesimo
+    gruppi = [(titolo, [c for c in colonne if c in df_mappa.columns]) for titolo, colonne in POPUP_GROUPS.items()]
+    colonne = [c for _, cols in gruppi for c in cols]
+    valori = {}
+    for col in colonne:
+        serie = df_mappa[col]
+        if pd.api.types.is_numeric_dtype(serie): serie = serie.astype('float64').round(2)
+        else: serie = serie.where(serie.astype(str).str.strip() != '')
+        valori[col] = serie.astype(object).where(serie.notna(), None)
+    righe = pd.DataFrame(valori, index=df_mappa.index).to_numpy().tolist() if colonne else [[] for _ in range(len(df_mappa))]
+    # Come in add_classic_markers: nello sheet LONGITUDINE contiene la latitudine e viceversa
+    coordinate = zip(pd.to_numeric(df_mappa['LATITUDINE'], errors='coerce').tolist(), pd.to_numeric(df_mappa['LONGITUDINE'], errors='coerce').tolist())
+    colori = df_mappa['LEGENDA_COLORE'].map(get_marker_color) if 'LEGENDA_COLORE' in df_mappa.columns else pd.Series("gray", index=df_mappa.index)
+    features = [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]}, "properties": {"c": colore, "s": str(stazione), "v": v}}
+        for (lon, lat), colore, stazione, v in zip(coordinate, colori.tolist(), df_mappa['STAZIONE'].tolist(), righe) if np.isfinite(lon) and np.isfinite(lat)
+    ]
+    etichette = [(titolo, [c.replace('LEGENDA_', '').replace('_', ' ').title() for c in cols]) for titolo, cols in gruppi]
+    return {"type": "FeatureCollection", "features": features}, etichette
+
+def build_main_map(df_mappa, map_tile, modalita="GeoJSON (veloce)", features=None):
+    # features: risultato di build_station_features già calcolato (prerender.py lo costruisce a blocchi di stazioni in parallelo)
+    mappa = create_map(map_tile); Geocoder(collapsed=True, placeholder='Cerca un luogo...', add_marker=True).add_to(mappa)
+    if modalita == "Classico": add_classic_markers(mappa, df_mappa)
+    else:
+        with profile_stage("marker"): StationLayer(*(features or build_station_features(df_mappa))).add_to(mappa)
+    return mappa
+
+def build_viewport_map(df_stato, posizioni, indice, map_tile, centro, zoom, bounds):
+    # Solo le stazioni nel riquadro visibile quando lo zoom lo consente, altrimenti un cerchio per cella della griglia
+    mappa = create_map(map_tile, location=centro, zoom=zoom); Geocoder(collapsed=True, placeholder='Cerca un luogo...', add_marker=True).add_to(mappa)
+    if zoom >= VIEWPORT_MIN_ZOOM and bounds is not None:
+        visibili = np.intersect1d(posizioni, query_bounds(indice, *bounds))
+        with profile_stage("marker"): StationLayer(*build_station_features(df_stato.iloc[visibili])).add_to(mappa)
+        return mappa, len(visibili)
+    with profile_stage("marker"):
+        for lat, lon, n in cluster_stations(indice, posizioni):
+            folium.CircleMarker(location=[lat, lon], radius=min(6 + 2 * np.sqrt(n), 30), color="#0057e7", fill=True, fill_color="#0057e7", fill_opacity=0.6, tooltip=f"{n} stazioni: avvicinati per vederle").add_to(mappa)
+    return mappa, 0
+
+def display_viewport_map(df_stato, posizioni, indice, map_tile):
+    # La vista (centro, zoom, riquadro) arriva da st_folium al rerun successivo a uno spostamento della mappa
+    vista = st.session_state.get("mappa_viewport") or {}
+    centro = [vista["center"]["lat"], vista["center"]["lng"]] if vista.get("center") else [43.8, 11.0]; zoom = int(vista.get("zoom") or 8)
+    riquadro = vista.get("bounds") or {}; bounds = None
+    if riquadro.get("_southWest") and riquadro.get("_northEast"):
+        bounds = (riquadro["_southWest"]["lat"], riquadro["_southWest"]["lng"], riquadro["_northEast"]["lat"], riquadro["_northEast"]["lng"])
+    mappa, n_visibili = build_viewport_map(df_stato, posizioni, indice, map_tile, centro, zoom, bounds)
+    if zoom >= VIEWPORT_MIN_ZOOM: st.caption(f"{n_visibili} stazioni nell'area visibile.")
+    else: st.caption(f"Stazioni raggruppate per area: avvicinati (zoom {VIEWPORT_MIN_ZOOM} o più) per vedere le singole stazioni.")
+    st_folium(mappa, key="mappa_viewport", width=1000, height=700, returned_objects=["bounds", "zoom", "center"])
+
+def display_nearest_stations(df_stato, indice):
+    with st.expander("📍 Stazioni più vicine a un luogo"):
+        luogo = st.text_input("Luogo o coordinate (lat, lon):", key="luogo_vicine", placeholder="es. Abetone oppure 44.14, 10.66")
+        if not luogo: return
+        posizione = parse_coordinates(luogo) or geocode_place(luogo)
+        if posizione is None: st.warning("Luogo non trovato."); return
+        lat, lon, nome = posizione; posizioni, distanze = query_nearest(indice, lat, lon)
+        colonne = [col for col in ['STAZIONE', 'LEGENDA_COMUNE', 'LEGENDA_ALTITUDINE', 'LEGENDA_COLORE'] if col in df_stato.columns]
+        tabella = df_stato.iloc[posizioni][colonne].reset_index(drop=True); tabella.insert(1, 'DISTANZA_KM', np.round(distanze, 1))
+        tabella['STORICO'] = '?station=' + tabella['STAZIONE'].astype(str).map(urllib.parse.quote)
+        st.caption(f"Stazioni più vicine a **{nome}**")
+        st.dataframe(tabella, hide_index=True, column_config={"STORICO": st.column_config.LinkColumn("Storico", display_text="📈 Apri")})
+
+@st.cache_resource(max_entries=4)
+def get_filter_engine(data_version, n_righe, _df_stato):
+    # Per ogni filtro con dati: valori già pronti per il confronto (NaN -> 0) e limite superiore dello slider, una volta per caricamento
+    valori, limiti = {}, {}
+    for filtri in RIEPILOGO_FILTERS.values():
+        for colonna, _ in filtri:
+            if colonna in _df_stato.columns and _df_stato[colonna].notna().any():
+                valori[colonna] = _df_stato[colonna].fillna(0).to_numpy(); limiti[colonna] = float(_df_stato[colonna].max())
+    return {"valori": valori, "limiti": limiti, "n_righe": n_righe}
+
+def apply_filters(motore, selezioni):
+    # Tutti i predicati di intervallo in un'unica maschera booleana: restituisce le posizioni delle righe, non una copia del frame
+    maschera = np.ones(motore["n_righe"], dtype=bool)
+    for colonna, (minimo, massimo) in selezioni.items():
+        valori = motore["valori"][colonna]; maschera &= (valori >= minimo) & (valori <= massimo)
+    return np.flatnonzero(maschera)
+
+def display_main_map(df, df_stato):
     st.header("🗺️ Mappa Riepilogativa (Situazione Attuale)")
-    last_date = df['DATA'].max(); df_latest = df[df['DATA'] == last_date].copy()
+    last_date = df_stato['DATA'].max()
     st.info(f"Visualizzazione dati aggiornati al: **{last_date.strftime('%d/%m/%Y')}**")
-    st.sidebar.title("Informazioni e Filtri Riepilogo"); st.sidebar.markdown("---"); map_tile = st.sidebar.selectbox("Tipo di mappa:", ["OpenStreetMap", "Stamen Terrain", "CartoDB positron"], key="tile_main")
-    st.sidebar.markdown("---"); st.sidebar.subheader("Statistiche"); counter = get_view_counter(); st.sidebar.info(f"Visite totali: **{counter['count']}**"); st.sidebar.info(f"App aggiornata il: **{df.attrs['last_loaded']}**")
-    if 'LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET' in df_latest.columns and not df_latest['LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET'].empty: st.sidebar.info(f"Sheet aggiornato il: **{df_latest['LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET'].iloc[0]}**")
-    st.sidebar.markdown("---"); st.sidebar.subheader("Filtri Dati Standard"); df_filtrato = df_latest.copy()
-    for colonna in COLONNE_FILTRO_RIEPILOGO:
-        if colonna in df_filtrato.columns and not df_filtrato[colonna].dropna().empty:
-            max_val = float(df_filtrato[colonna].max()); slider_label = colonna.replace('LEGENDA_', '').replace('_', ' ').title()
-            val_selezionato = st.sidebar.slider(f"Filtra per {slider_label}", 0.0, max_val, (0.0, max_val))
-            df_filtrato = df_filtrato[df_filtrato[colonna].fillna(0).between(val_selezionato[0], val_selezionato[1])]
-    st.sidebar.markdown("---"); st.sidebar.subheader("Filtri Sbalzo Termico")
-    for sbalzo_col, suffisso in [("LEGENDA_SBALZO_NUMERICO_MIGLIORE", "Migliore"), ("LEGENDA_SBALZO_NUMERICO_SECONDO", "Secondo")]:
-        if sbalzo_col in df_filtrato.columns and not df_filtrato[sbalzo_col].dropna().empty:
-            max_val = float(df_filtrato[sbalzo_col].max()); val_selezionato = st.sidebar.slider(f"Sbalzo Termico {suffisso}", 0.0, max_val, (0.0, max_val))
-            df_filtrato = df_filtrato[df_filtrato[sbalzo_col].fillna(0).between(val_selezionato[0], val_selezionato[1])]
-    st.sidebar.markdown("---"); st.sidebar.success(f"Visualizzati {len(df_filtrato)} marker sulla mappa.")
-    df_mappa = df_filtrato.dropna(subset=['LATITUDINE', 'LONGITUDINE']).copy()
-    mappa = create_map(map_tile); Geocoder(collapsed=True, placeholder='Cerca un luogo...', add_marker=True).add_to(mappa)
-    
-    def create_popup_html(row):
-        html = """<style>.popup-container{font-family:Arial,sans-serif;font-size:13px;max-height:350px;overflow-y:auto;overflow-x:hidden}h4{margin-top:12px;margin-bottom:5px;color:#0057e7;border-bottom:1px solid #ccc;padding-bottom:3px}table{width:100%;border-collapse:collapse;margin-bottom:10px}td{text-align:left;padding:4px;border-bottom:1px solid #eee}td:first-child{font-weight:bold;color:#333;width:65%}td:last-child{color:#555}.btn-container{text-align:center;margin-top:15px;}.btn{background-color:#007bff;color:white;padding:8px 12px;border-radius:5px;text-decoration:none;font-weight:bold;}</style><div class="popup-container">"""
-        groups = { 
-            "Info Stazione": ["STAZIONE", "LEGENDA_DESCRIZIONE", "LEGENDA_COMUNE", "LEGENDA_ALTITUDINE"], 
-            "Dati Meteo": ["LEGENDA_TEMPERATURA_MEDIANA_MINIMA", "LEGENDA_TEMPERATURA_MEDIANA", "LEGENDA_UMIDITA_MEDIA_7GG", "LEGENDA_PIOGGE_RESIDUA", "LEGENDA_TOTALE_PIOGGE_MENSILI"], 
-            "Analisi Base": ["LEGENDA_MEDIA_PORCINI_CALDO_BASE", "LEGENDA_MEDIA_PORCINI_CALDO_BOOST", "LEGENDA_DURATA_RANGE_CALDO", "LEGENDA_CONTEGGIO_GG_ALLA_RACCOLTA_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_BASE", "LEGENDA_MEDIA_PORCINI_FREDDO_BOOST", "LEGENDA_DURATA_RANGE_FREDDO", "LEGENDA_CONTEGGIO_GG_ALLA_RACCOLTA_FREDDO"], 
-            "Analisi Sbalzo Migliore": ["LEGENDA_SBALZO_TERMICO_MIGLIORE", "LEGENDA_MEDIA_PORCINI_CALDO_ST_MIGLIORE", "LEGENDA_MEDIA_BOOST_CALDO_ST_MIGLIORE", "LEGENDA_GG_ST_MIGLIORE_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_ST_MIGLIORE", "LEGENDA_MEDIA_BOOST_FREDDO_ST_MIGLIORE", "LEGENDA_GG_ST_MIGLIORE_FREDDO"], 
-            "Analisi Sbalzo Secondo": ["LEGENDA_SBALZO_TERMICO_SECONDO", "LEGENDA_MEDIA_PORCINI_CALDO_ST_SECONDO", "LEGENDA_MEDIA_BOOST_CALDO_ST_SECONDO", "LEGENDA_GG_ST_SECONDO_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_ST_SECONDO", "LEGENDA_MEDIA_BOOST_FREDDO_ST_SECONDO", "LEGENDA_GG_ST_SECONDO_FREDDO"] 
-        }
-        for title, columns in groups.items():
-            table_html = "<table>"; has_content = False
-            for col_name_actual in columns:
-                if col_name_actual in row.index and pd.notna(row[col_name_actual]) and str(row[col_name_actual]).strip() != '':
-                    has_content = True; value = row[col_name_actual]
-                    col_name_label = col_name_actual.replace('LEGENDA_', '').replace('_', ' ').title()
-                    if isinstance(value, (int, float)): value_str = f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-                    else: value_str = str(value)
-                    table_html += f"<tr><td>{col_name_label}</td><td>{value_str}</td></tr>"
-            table_html += "</table>"
-            if has_content: html += f"<h4>{title}</h4>{table_html}"
-        station_name_for_url = row['STAZIONE']; link = f'?station={station_name_for_url}'; html += f'<div class="btn-container"><a href="{link}" target="_self" class="btn">📈 Mostra Storico Stazione</a></div>'; html += "</div>"
-        return html
-
-    def get_marker_color(val): return {"ROSSO": "red", "GIALLO": "yellow", "ARANCIONE": "orange", "VERDE": "green"}.get(str(val).strip().upper(), "gray")
-    
-    for _, row in df_mappa.iterrows():
+    st.sidebar.title("Informazioni e Filtri Riepilogo"); st.sidebar.markdown("---"); map_tile = st.sidebar.selectbox("Tipo di mappa:", MAP_TILES, key="tile_main")
+    st.sidebar.markdown("---"); st.sidebar.subheader("Statistiche"); counter = get_view_counter(); st.sidebar.info(f"Visite totali: **{counter['count']}**")
+    pannello_prestazioni = st.sidebar.container() if PROFILING_PANEL else None; st.sidebar.info(f"App aggiornata il: **{df.attrs['last_loaded']}**")
+    if 'LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET' in df_stato.columns and not df_stato['LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET'].empty: st.sidebar.info(f"Sheet aggiornato il: **{df_stato['LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET'].iloc[0]}**")
+    refresher = get_data_refresher(SHEET_URL)
+    if refresher.ultimo_errore: st.sidebar.warning(f"Ultimo aggiornamento dello sheet fallito ({refresher.ultimo_errore}): dati dall'ultimo caricamento riuscito.")
+    cache_stats = st.sidebar.empty()
+    # Limiti degli slider fissi per versione dei dati: le selezioni si combinano in un'unica maschera
+    motore = get_filter_engine(df.attrs['last_loaded'], len(df_stato), df_stato); selezioni = {}; filtri = []
+    for sezione, definizioni in RIEPILOGO_FILTERS.items():
+        st.sidebar.markdown("---"); st.sidebar.subheader(sezione)
+        for colonna, etichetta in definizioni:
+            if colonna not in motore["limiti"]: continue
+            max_val = motore["limiti"][colonna]; selezioni[colonna] = st.sidebar.slider(etichetta, 0.0, max_val, (0.0, max_val))
+            filtri.append((colonna, normalize_range(selezioni[colonna], max_val)))
+    with profile_stage("filtri"): indici = apply_filters(motore, selezioni)
+    st.sidebar.markdown("---"); st.sidebar.success(f"Visualizzati {len(indici)} marker sulla mappa.")
+    modalita_marker = st.sidebar.radio("Rendering marker:", ["GeoJSON (veloce)", "Classico", "Area visibile (reti grandi)"], key="marker_mode")
+    indice_spaziale = get_spatial_index(df.attrs['last_loaded'], len(df_stato), df_stato)
+    if modalita_marker == "Area visibile (reti grandi)": display_viewport_map(df_stato, indici, indice_spaziale, map_tile)
+    else:
+        chiave = (df.attrs['last_loaded'], "riepilogo", map_tile, modalita_marker, tuple(filtri))
+        statica = get_prerendered_map(prerender_name("riepilogo", map_tile), prerender_signature(df_stato)) if modalita_marker == "GeoJSON (veloce)" and all(r is None for _, r in filtri) else None
+        show_map_html(statica or render_map_cached(chiave, lambda: build_main_map(df_stato.iloc[indici], map_tile, modalita_marker)))
+    display_nearest_stations(df_stato, indice_spaziale)
+    cache = get_map_cache(); cache_stats.info(f"Cache mappe: **{cache['hits']}** hit / **{cache['misses']}** miss ({len(cache['mappe'])} mappe, {cache['byte'] / 1e6:.1f} MB)")
+    if pannello_prestazioni is not None: display_profiler_panel(pannello_prestazioni)
+
+def scrivi_plotly_statico():
+    # Copia di plotly.js servita da Streamlit come app/static/<nome>, scritta una volta per versione di plotly
+    nome = f"plotly-{get_plotlyjs_version()}.min.js"; percorso = os.path.join(PLOTLY_STATIC_DIR, nome)
+    if not os.path.exists(percorso):
         try:
-            lat, lon = float(row['LONGITUDINE']), float(row['LATITUDINE'])
-            colore = get_marker_color(row.get('LEGENDA_COLORE', 'gray')); popup_html = create_popup_html(row)
-            folium.CircleMarker(location=[lat, lon], radius=6, color=colore, fill=True, fill_color=colore, fill_opacity=0.9, popup=folium.Popup(popup_html, max_width=380)).add_to(mappa)
-        except (ValueError, TypeError): continue
-    folium_static(mappa, width=1000, height=700)
+            os.makedirs(PLOTLY_STATIC_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=PLOTLY_STATIC_DIR, prefix=f"{nome}.", suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f: f.write(get_plotlyjs())
+            os.chmod(tmp_path, 0o644); os.replace(tmp_path, percorso)
+        except OSError: pass  # cartella non scrivibile: resta la CDN
+    return nome
+
+@st.cache_resource
+def get_plotly_js_tag(modalita):
+    # plotly.js una sola volta per pagina, senza richieste di rete dal server. Con la CDN il fallback è deciso dal browser:
+    # la copia locale si carica solo se dopo lo script della CDN window.Plotly non esiste (offline, CDN bloccata)
+    if modalita == "inline": return f'<script type="text/javascript">{get_plotlyjs()}</script>'
+    locale = f"app/static/{scrivi_plotly_statico()}"
+    return (f'<script src="https://cdn.plot.ly/plotly-{get_plotlyjs_version()}.min.js" charset="utf-8"></script>'
+            f'<script>window.Plotly || document.write(\'<script src="{locale}" charset="utf-8"><\\/script>\')</script>')
 
-def display_period_analysis(df):
+def build_period_chart_template():
+    # Grafico del popup costruito una volta con valori segnaposto: il browser sostituisce solo valore, etichetta e titolo
+    fig = go.Figure(go.Bar(x=['Pioggia Totale'], y=[0], marker_color='#007bff', text=[""], textposition='auto'))
+    fig.update_layout(title_text="", title_font_size=14, yaxis_title="mm", width=250, height=200, margin=dict(l=40, r=20, t=40, b=20), showlegend=False)
+    with profile_stage("grafici"): return fig.to_json()
+
+class PeriodLayer(MacroElement):
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var modello = {{ this.modello }};
+            var renderer = L.canvas();
+            {{ this.dati|tojson }}.forEach(function(d) {
+                var etichetta = d[3].toFixed(1) + " mm";
+                var marker = L.circleMarker([d[0], d[1]], {renderer: renderer, radius: 8, color: d[4], fill: true, fillColor: d[4], fillOpacity: 0.7})
+                    .bindTooltip(d[2] + ": " + etichetta)
+                    .bindPopup('<div style="width:250px;height:200px"></div>', {maxWidth: 300});
+                marker.on("popupopen", function(e) {
+                    var grafico = JSON.parse(JSON.stringify(modello));
+                    grafico.data[0].y = [d[3]]; grafico.data[0].text = [etichetta]; grafico.layout.title.text = "<b>" + d[2] + "</b>";
+                    Plotly.newPlot(e.popup.getElement().querySelector(".leaflet-popup-content div"), grafico.data, grafico.layout, {displayModeBar: false});
+                });
+                marker.addTo({{ this._parent.get_name() }});
+            });
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, dati):
+        super().__init__()
+        self._name = "PeriodLayer"; self.dati = dati; self.modello = build_period_chart_template(); self.plotly_js = get_plotly_js_tag(PLOTLY_JS_MODE)
+
+    def render(self, **kwargs):
+        super().render(**kwargs)
+        # Il bundle di plotly.js contiene sintassi simile a jinja: va passato come valore e non come sorgente del template
+        plotly_js = Element("{{ this.html }}"); plotly_js.html = self.plotly_js
+        self.get_root().header.add_child(plotly_js, name="plotly_js")
+
+def build_period_map(df_agg, map_tile):
+    mappa = create_map(map_tile, location=[df_agg['LONGITUDINE'].mean(), df_agg['LATITUDINE'].mean()])
+    min_rain, max_rain = df_agg['TOTALE_PIOGGIA_GIORNO'].min(), df_agg['TOTALE_PIOGGIA_GIORNO'].max()
+    colormap = linear.YlGnBu_09.scale(vmin=min_rain, vmax=max_rain if max_rain > min_rain else min_rain + 1)
+    colormap.caption = 'Totale Piogge (mm) nel Periodo'; mappa.add_child(colormap)
+    with profile_stage("marker"):
+        piogge = df_agg['TOTALE_PIOGGIA_GIORNO'].astype('float64').round(2).tolist()
+        dati = [[lat, lon, str(stazione), pioggia, colormap(pioggia)] for lat, lon, stazione, pioggia in zip(df_agg['LONGITUDINE'].astype('float64').tolist(), df_agg['LATITUDINE'].astype('float64').tolist(), df_agg['STAZIONE'].tolist(), piogge)]
+    PeriodLayer(dati).add_to(mappa)
+    return mappa
+
+def display_period_analysis(df, df_stato):
     st.header("📊 Analisi di Periodo con Piogge Aggregate"); st.sidebar.title("Filtri di Periodo")
-    map_tile = st.sidebar.selectbox("Tipo di mappa:", ["OpenStreetMap", "Stamen Terrain", "CartoDB positron"], key="tile_period")
-    min_date, max_date = df['DATA'].min().date(), df['DATA'].max().date()
+    map_tile = st.sidebar.selectbox("Tipo di mappa:", MAP_TILES, key="tile_period")
+    cubo = get_period_cube(df.attrs['last_loaded'], len(df), df); min_date, max_date = cubo["prima_data"], cubo["ultima_data"]
     date_range = st.sidebar.date_input("Seleziona un periodo:", value=(max_date, max_date), min_value=min_date, max_value=max_date)
     if len(date_range) != 2: st.warning("Seleziona un intervallo di date valido."); st.stop()
-    start_date, end_date = date_range; df_filtered = df[df['DATA'].dt.date.between(start_date, end_date)]
-    agg_cols = {'TOTALE_PIOGGIA_GIORNO': 'sum', 'LATITUDINE': 'first', 'LONGITUDINE': 'first'}; df_agg = df_filtered.groupby('STAZIONE').agg(agg_cols).reset_index()
+    start_date, end_date = date_range; df_agg = aggregate_period(cubo, start_date, end_date)
     df_agg = df_agg[df_agg['TOTALE_PIOGGIA_GIORNO'] > 0]
     if not df_agg.empty:
         max_rain_filter = float(df_agg['TOTALE_PIOGGIA_GIORNO'].max())
@@ -156,84 +842,50 @@ def display_period_analysis(df):
         df_agg = df_agg[df_agg['TOTALE_PIOGGIA_GIORNO'].between(rain_range[0], rain_range[1])]
     st.info(f"Visualizzando **{len(df_agg)}** stazioni con precipitazioni nel periodo selezionato.")
     if df_agg.empty: st.warning("Nessuna stazione corrisponde ai filtri selezionati."); return
-    mappa = create_map(map_tile, location=[df_agg['LONGITUDINE'].mean(), df_agg['LATITUDINE'].mean()])
-    min_rain, max_rain = df_agg['TOTALE_PIOGGIA_GIORNO'].min(), df_agg['TOTALE_PIOGGIA_GIORNO'].max()
-    colormap = linear.YlGnBu_09.scale(vmin=min_rain, vmax=max_rain if max_rain > min_rain else min_rain + 1)
-    colormap.caption = 'Totale Piogge (mm) nel Periodo'; mappa.add_child(colormap)
-    for _, row in df_agg.iterrows():
-        fig = go.Figure(go.Bar(x=['Pioggia Totale'], y=[row['TOTALE_PIOGGIA_GIORNO']], marker_color='#007bff', text=[f"{row['TOTALE_PIOGGIA_GIORNO']:.1f} mm"], textposition='auto'))
-        fig.update_layout(title_text=f"<b>{row['STAZIONE']}</b>", title_font_size=14, yaxis_title="mm", width=250, height=200, margin=dict(l=40, r=20, t=40, b=20), showlegend=False)
-        config = {'displayModeBar': False}; html_chart = fig.to_html(full_html=False, include_plotlyjs='cdn', config=config)
-        iframe = folium.IFrame(html_chart, width=280, height=230); popup = folium.Popup(iframe, max_width=300)
-        lat, lon = float(row['LONGITUDINE']), float(row['LATITUDINE'])
-        color = colormap(row['TOTALE_PIOGGIA_GIORNO'])
-        folium.CircleMarker(location=[lat, lon], radius=8, color=color, fill=True, fill_color=color, fill_opacity=0.7, popup=popup, tooltip=f"{row['STAZIONE']}: {row['TOTALE_PIOGGIA_GIORNO']:.1f} mm").add_to(mappa)
-    folium_static(mappa, width=1000, height=700)
+    chiave = (df.attrs['last_loaded'], "periodo", map_tile, start_date, end_date, normalize_range(rain_range, max_rain_filter))
+    giorni = (end_date - start_date).days + 1; statica = None
+    if end_date == max_date and giorni in PRERENDER_PERIOD_DAYS and chiave[-1] is None: statica = get_prerendered_map(prerender_name("periodo", map_tile, giorni), prerender_signature(df_stato))
+    show_map_html(statica or render_map_cached(chiave, lambda: build_period_map(df_agg, map_tile)))
     with st.expander("Vedi dati aggregati"): st.dataframe(df_agg)
 
 def add_sbalzo_line(fig, df_data, sbalzo_col_name, label):
-    # Blocco di Diagnosi (lo manteniamo per sicurezza)
-    if sbalzo_col_name not in df_data.columns:
-        st.warning(f"DEBUG: La colonna '{sbalzo_col_name}' NON è stata trovata.")
-        return 
-        
-    df_valid_sbalzo = df_data.dropna(subset=[sbalzo_col_name])
-    
-    if df_valid_sbalzo.empty:
-        # Rimuoviamo questo messaggio per non sporcare l'interfaccia, ora sappiamo che il problema non è qui
-        # st.info(f"DEBUG: La colonna '{sbalzo_col_name}' esiste, ma non ci sono valori per questa stazione.")
-        return
-    
-    # Ciclo di processamento
-    for index, row in df_valid_sbalzo.iterrows():
-        sbalzo_str = str(row[sbalzo_col_name])
-        
-        if " - " in sbalzo_str:
-            try:
-                valore, data_str = sbalzo_str.split(" - ", 1)
-                sbalzo_val = valore.strip().replace(",", ".")
-                sbalzo_date = datetime.strptime(data_str.strip(), "%d/%m/%Y")
-                
-                # --- NUOVO METODO ROBUSTO ---
-                
-                # 1. Disegna la linea verticale usando add_shape
-                fig.add_shape(
-                    type="line",
-                    x0=sbalzo_date, y0=0,
-                    x1=sbalzo_date, y1=1,
-                    line=dict(color="Green", width=2, dash="dash"),
-                    xref="x", yref="paper"  # yref='paper' fa sì che la linea occupi tutta l'altezza del grafico
-                )
-                
-                # 2. Aggiunge l'annotazione di testo separatamente
-                fig.add_annotation(
-                    x=sbalzo_date,
-                    y=1.05,  # Posiziona l'annotazione leggermente sopra la parte alta del grafico
-                    xref="x", yref="paper",
-                    text=f"{label} ({sbalzo_val})",
-                    showarrow=False,
-                    xanchor="left",
-                    font=dict(
-                        family="Arial",
-                        size=12,
-                        color="black"
-                    )
-                )
-
-            except ValueError:
-                st.error(f"DEBUG: Impossibile processare il valore '{sbalzo_str}'. Formato data non valido.")
-                continue
-        else:
-            st.warning(f"DEBUG: Valore '{sbalzo_str}' non nel formato atteso.")
+    # Usa le colonne SBALZO_NUMERICO_*/SBALZO_DATA_* calcolate al caricamento: lo stesso evento si ripete per molti
+    # giorni, quindi si disegnano solo gli eventi distinti, tutti insieme in un unico aggiornamento del layout
+    suffisso = SBALZO_EVENT_COLUMNS.get(sbalzo_col_name)
+    col_valore, col_data = f"SBALZO_NUMERICO_{suffisso}", f"SBALZO_DATA_{suffisso}"
+    if suffisso is None or col_data not in df_data.columns: return
+    eventi = df_data[[col_valore, col_data]].dropna(subset=[col_data]).drop_duplicates()
+    if eventi.empty: return
+    shapes, annotations = [], []
+    for sbalzo_val, sbalzo_date in zip(eventi[col_valore].tolist(), eventi[col_data].tolist()):
+        # 1. Linea verticale (yref='paper' fa sì che la linea occupi tutta l'altezza del grafico)
+        shapes.append(dict(type="line", x0=sbalzo_date, y0=0, x1=sbalzo_date, y1=1, line=dict(color="Green", width=2, dash="dash"), xref="x", yref="paper"))
+        # 2. Annotazione leggermente sopra la parte alta del grafico
+        testo = f"{label} ({sbalzo_val:g})" if pd.notna(sbalzo_val) else label
+        annotations.append(dict(x=sbalzo_date, y=1.05, xref="x", yref="paper", text=testo, showarrow=False, xanchor="left", font=dict(family="Arial", size=12, color="black")))
+    fig.update_layout(shapes=list(fig.layout.shapes) + shapes, annotations=list(fig.layout.annotations) + annotations)
 # --- INIZIO DEL BLOCCO DA COPIARE ---
 
+def decimate_history(df_chart, colonne, inizio_finestra, n_bucket=DECIMATION_BUCKETS):
+    # Finestra visibile a piena risoluzione; lo storico precedente diventa una panoramica min-max su n_bucket intervalli
+    # (per ogni intervallo si tengono le righe con minimo e massimo di ciascuna colonna, così i picchi restano visibili)
+    storico = df_chart[df_chart['DATA'] < inizio_finestra]; n_storico = len(storico)
+    if n_storico <= 2 * n_bucket * len(colonne): return df_chart
+    bucket = np.arange(n_storico) * n_bucket // n_storico
+    inizio_bucket = lambda ordine: ordine[np.r_[True, np.diff(bucket[ordine]) != 0]]
+    posizioni = [np.array([0, n_storico - 1])]
+    for col in colonne:
+        valori = storico[col].to_numpy(dtype='float64')
+        posizioni += [inizio_bucket(np.lexsort((valori, bucket))), inizio_bucket(np.lexsort((-valori, bucket)))]
+    return pd.concat([storico.iloc[np.unique(np.concatenate(posizioni))], df_chart[df_chart['DATA'] >= inizio_finestra]])
+
 def display_station_detail(df, station_name):
     if st.button("⬅️ Torna alla Mappa Riepilogativa"):
         st.session_state['password_correct'] = True
         st.query_params.clear()
 
     st.header(f"📈 Storico Dettagliato: {station_name}")
-    df_station = df[df['STAZIONE'] == station_name].sort_values('DATA').copy()
+    df_station = get_station_history(df, station_name)
 
     if df_station.empty:
         st.error("Dati non trovati.")
@@ -259,11 +911,16 @@ def display_station_detail(df, station_name):
     }
     # --- FINE MODIFICA ---
 
+    # 3. Fuori dalla finestra predefinita i grafici ricevono solo una panoramica ridotta, salvo richiesta esplicita
+    storia_completa = st.toggle("Carica tutta la storia nei grafici", value=False, help="Senza questa opzione i dati precedenti agli ultimi 40 giorni sono campionati (minimi e massimi) per alleggerire la pagina.")
+    def dati_grafico(df_chart, colonne): return df_chart if storia_completa else decimate_history(df_chart, colonne, start_date_default)
+
     # Grafico Piogge Giorno
     st.subheader("Andamento Precipitazioni Giornaliere")
+    df_fig1 = dati_grafico(df_station, ['TOTALE_PIOGGIA_GIORNO'])
     fig1 = go.Figure(go.Bar(
-        x=df_station['DATA'],
-        y=df_station['TOTALE_PIOGGIA_GIORNO']
+        x=df_fig1['DATA'],
+        y=df_fig1['TOTALE_PIOGGIA_GIORNO']
     ))
 
     # --- NUOVA MODIFICA: IMPOSTA ZOOM E ASSI FISSI PER FIGURA 1 ---
@@ -278,7 +935,7 @@ def display_station_detail(df, station_name):
         yaxis_range=[0, max_y_rain] # Imposta asse Y fisso
     )
     # Aggiungiamo 'config' per abilitare il download
-    st.plotly_chart(fig1, use_container_width=True, config=config_chart)
+    with profile_stage("grafici"): st.plotly_chart(fig1, use_container_width=True, config=config_chart)
     # --- FINE MODIFICA ---
 
 
@@ -290,18 +947,19 @@ def display_station_detail(df, station_name):
         df_chart = df_station.dropna(subset=cols_needed)
 
         if not df_chart.empty:
+            df_fig2 = dati_grafico(df_chart, cols_needed)
             fig2 = make_subplots(specs=[[{"secondary_y": True}]])
             fig2.add_trace(go.Scatter(
-                x=df_chart['DATA'],
-                y=df_chart['PIOGGE_RESIDUA_ZOFFOLI'],
+                x=df_fig2['DATA'],
+                y=df_fig2['PIOGGE_RESIDUA_ZOFFOLI'],
                 name='Piogge Residua',
                 mode='lines',
                 line=dict(color='blue')
             ), secondary_y=False)
 
             fig2.add_trace(go.Scatter(
-                x=df_chart['DATA'],
-                y=df_chart['TEMPERATURA_MEDIANA'],
+                x=df_fig2['DATA'],
+                y=df_fig2['TEMPERATURA_MEDIANA'],
                 name='Temperatura Mediana',
                 mode='lines',
                 line=dict(color='red')
@@ -331,16 +989,17 @@ def display_station_detail(df, station_name):
             add_sbalzo_line(fig2, df_station, '2°_SBALZO_TERMICO_MIGLIORE', '2° Sbalzo')
             
             # Aggiungiamo 'config' per abilitare il download
-            st.plotly_chart(fig2, use_container_width=True, config=config_chart)
+            with profile_stage("grafici"): st.plotly_chart(fig2, use_container_width=True, config=config_chart)
 
     else:
         st.warning("Dati di Piogge Residue o Temperatura Mediana non disponibili per creare il grafico.")
 
     # Grafico temperature min/max
     st.subheader("Andamento Temperature Minime e Massime")
+    df_fig3 = dati_grafico(df_station, ['TEMP_MAX', 'TEMP_MIN'])
     fig3 = go.Figure()
-    fig3.add_trace(go.Scatter(x=df_station['DATA'], y=df_station['TEMP_MAX'], name='Temp Max', line=dict(color='orangered')))
-    fig3.add_trace(go.Scatter(x=df_station['DATA'], y=df_station['TEMP_MIN'], name='Temp Min', line=dict(color='skyblue'), fill='tonexty'))
+    fig3.add_trace(go.Scatter(x=df_fig3['DATA'], y=df_fig3['TEMP_MAX'], name='Temp Max', line=dict(color='orangered')))
+    fig3.add_trace(go.Scatter(x=df_fig3['DATA'], y=df_fig3['TEMP_MIN'], name='Temp Min', line=dict(color='skyblue'), fill='tonexty'))
 
     # --- NUOVA MODIFICA: IMPOSTA ZOOM E ASSI FISSI PER FIGURA 3 ---
     # Calcola i valori massimi e minimi sull'intera storia per l'asse Y
@@ -355,13 +1014,13 @@ def display_station_detail(df, station_name):
         yaxis_range=[min_y_temp, max_y_temp] # Imposta asse Y fisso
     )
     # Aggiungiamo 'config' per abilitare il download
-    st.plotly_chart(fig3, use_container_width=True, config=config_chart)
+    with profile_stage("grafici"): st.plotly_chart(fig3, use_container_width=True, config=config_chart)
     # --- FINE MODIFICA ---
 
 
     # Tabella dati storici completi
     with st.expander("Visualizza tabella dati storici completi"):
-        all_cols_historic = sorted([col for col in df_station.columns if not col.startswith('LEGENDA_') and col not in ['LATITUDINE', 'LONGITUDINE', 'COORDINATEGOOGLE']])
+        all_cols_historic = sorted([col for col in df_station.columns if col not in ['LATITUDINE', 'LONGITUDINE']])
         default_cols_ordered = [
             'DATA', 'STAZIONE', 'TOTALE_PIOGGIA_GIORNO', 'PIOGGE_RESIDUA_ZOFFOLI',
             'TEMP_MIN', 'TEMP_MAX', 'TEMPERATURA_MEDIANA', 'TEMPERATURA_MEDIANA_MINIMA',
@@ -384,8 +1043,9 @@ def main():
     st.set_page_config(page_title="Mappa Funghi Protetta", layout="wide")
     st.title("💧 Analisi Meteo Funghi – by Bobo 🍄")
     query_params = st.query_params
-    df = load_and_prepare_data(SHEET_URL)
-    if df is None or df.empty: st.warning("Dati non disponibili o caricamento fallito."); st.stop()
+    dati = get_data_refresher(SHEET_URL).get()
+    if dati is None or dati[0].empty: st.warning("Dati non disponibili o caricamento fallito."); st.stop()
+    df, df_stato = dati
     if "station" in query_params:
         st.session_state['password_correct'] = True
         display_station_detail(df, query_params["station"])
@@ -394,8 +1054,8 @@ def main():
             counter = get_view_counter()
             if st.session_state.get('just_logged_in', True): counter["count"] += 1; st.session_state['just_logged_in'] = False
             mode = st.radio("Seleziona la modalità:", ["Mappa Riepilogativa", "Analisi di Periodo"], horizontal=True)
-            if mode == "Mappa Riepilogativa": display_main_map(df)
-            elif mode == "Analisi di Periodo": display_period_analysis(df)
+            if mode == "Mappa Riepilogativa": display_main_map(df, df_stato)
+            elif mode == "Analisi di Periodo": display_period_analysis(df, df_stato)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,151 @@
+# Benchmark dei percorsi critici dell'app su sheet sintetici (nessuna rete, nessun browser).
+# Uso: python benchmark.py parsing --stazioni 300 --anni 5
+# Confronti prima/dopo delle ottimizzazioni; i benchmark delle fasi con soglia di regressione sono in tests/test_benchmark_stadi.py
+import argparse
+import io
+import pickle
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import app
+
+COLONNE_LEGENDA_NUMERICHE = [
+    "ALTITUDINE", "TEMPERATURA MEDIANA MINIMA", "TEMPERATURA MEDIANA", "UMIDITA MEDIA 7GG", "PIOGGE RESIDUA", "Totale Piogge Mensili",
+    "MEDIA PORCINI CALDO BASE", "MEDIA PORCINI CALDO BOOST", "DURATA RANGE CALDO", "CONTEGGIO GG ALLA RACCOLTA CALDO",
+    "MEDIA PORCINI FREDDO BASE", "MEDIA PORCINI FREDDO BOOST", "DURATA RANGE FREDDO", "CONTEGGIO GG ALLA RACCOLTA FREDDO",
+    "MEDIA PORCINI CALDO ST MIGLIORE", "MEDIA BOOST CALDO ST MIGLIORE", "GG ST MIGLIORE CALDO", "MEDIA PORCINI FREDDO ST MIGLIORE",
+    "MEDIA BOOST FREDDO ST MIGLIORE", "GG ST MIGLIORE FREDDO", "MEDIA PORCINI CALDO ST SECONDO", "MEDIA BOOST CALDO ST SECONDO",
+    "GG ST SECONDO CALDO", "MEDIA PORCINI FREDDO ST SECONDO", "MEDIA BOOST FREDDO ST SECONDO", "GG ST SECONDO FREDDO"
+]
+COLONNE_STORICHE_NUMERICHE = [
+    "TOTALE PIOGGIA GIORNO", "PIOGGE RESIDUA ZOFFOLI", "TEMP MIN", "TEMP MAX", "TEMPERATURA MEDIANA", "TEMPERATURA MEDIANA MINIMA",
+    "UMIDITA DEL GIORNO", "UMIDITA MEDIA 7GG", "VENTO", "DURATA RANGE", "CONTEGGIO GG ALLA RACCOLTA", "BOOST"
+]
+
+def genera_sheet(n_stazioni=300, n_giorni=5 * 365, seed=0, fine="2025-10-10"):
+    """Restituisce un frame con le stesse colonne e gli stessi formati dello sheet pubblicato."""
+    rng = np.random.default_rng(seed)
+    date = pd.date_range(end=fine, periods=n_giorni)
+    n = n_stazioni * n_giorni
+    stazioni = np.array([f"Stazione {i:04d}" for i in range(n_stazioni)])
+    per_riga = lambda valori: np.repeat(valori, n_giorni)
+    def sbalzo():
+        # Come nello sheet: lo stesso evento "valore - data" resta in vigore per circa tre settimane
+        evento = np.arange(n) // 21
+        valori = pd.Series(rng.uniform(2, 9, evento.max() + 1).round(1)).astype(str).str.replace('.', ',').to_numpy()[evento]
+        return np.where(rng.random(evento.max() + 1)[evento] < 0.6, valori + " - " + np.tile(date.strftime("%d/%m/%Y"), n_stazioni)[evento * 21], None)
+    df = pd.DataFrame({
+        "STAZIONE": per_riga(stazioni), "DATA": np.tile(date.strftime("%d/%m/%Y"), n_stazioni),
+        "LONGITUDINE": per_riga(rng.uniform(42.3, 44.5, n_stazioni).round(5)), "LATITUDINE": per_riga(rng.uniform(9.7, 12.4, n_stazioni).round(5)),
+        "COORDINATE GOOGLE": per_riga([f"{i}" for i in range(n_stazioni)]),
+    })
+    for col in COLONNE_STORICHE_NUMERICHE: df[col] = rng.uniform(0, 40, n).round(2)
+    df["TOTALE PIOGGIA GIORNO"] = np.where(rng.random(n) < 0.3, rng.gamma(2.0, 5.0, n), 0.0).round(1)
+    df["SBALZO TERMICO MIGLIORE"], df["2° SBALZO TERMICO MIGLIORE"] = sbalzo(), sbalzo()
+    df["PORCINI CALDO NOTE"] = np.where(rng.random(n) < 0.05, "Nota", None); df["PORCINI FREDDO NOTE"] = np.where(rng.random(n) < 0.05, "Nota", None)
+    df["Legenda_DESCRIZIONE"] = per_riga([f"Descrizione {i}" for i in range(n_stazioni)]); df["Legenda_COMUNE"] = per_riga([f"Comune {i % 120}" for i in range(n_stazioni)])
+    for col in COLONNE_LEGENDA_NUMERICHE: df[f"Legenda_{col}"] = rng.uniform(0, 3000, n).round(2)
+    df["Legenda_SBALZO TERMICO MIGLIORE"], df["Legenda_SBALZO TERMICO SECONDO"] = sbalzo(), sbalzo()
+    df["Legenda_COLORE"] = rng.choice(["ROSSO", "GIALLO", "ARANCIONE", "VERDE", "#N/D"], n)
+    df["Legenda_ULTIMO_AGGIORNAMENTO_SHEET"] = "10/10/2025 08:00"
+    return df
+
+def genera_csv(n_stazioni=300, n_giorni=5 * 365, seed=0):
+    # Come lo sheet pubblicato: intestazione, una riga di unità (saltata dal parser) e poi i dati con la virgola decimale
+    df = genera_sheet(n_stazioni, n_giorni, seed)
+    intestazione = df.head(0).to_csv(index=False) + ",".join(["-"] * len(df.columns)) + "\n"
+    return (intestazione + df.to_csv(index=False, header=False, decimal=',')).encode()
+
+def genera_frame(n_stazioni=300, n_giorni=5 * 365, seed=0):
+    """Righe dello sheet già tipizzate da prepara_righe, prima della separazione in storico e stato attuale."""
+    df = app.prepara_righe(app.leggi_csv(genera_csv(n_stazioni, n_giorni, seed)))
+    df.attrs['last_loaded'] = f"benchmark {n_stazioni}x{n_giorni}"
+    return df
+
+def parsing_originale(data):
+    # Percorso di caricamento precedente allo schema: tutto come testo e poi una conversione per colonna
+    df = pd.read_csv(io.BytesIO(data), na_values=["#N/D", "#N/A"], dtype=str, header=0, skiprows=[1])
+    df = df.rename(columns={col: app.pulisci_nome(col) for col in df.columns}); df = df.loc[:, ~df.columns.duplicated()]
+    for col in df.columns:
+        if col == 'DATA': df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True)
+        elif col not in app.TEXT_COLUMNS: df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '.', regex=False), errors='coerce')
+    return df
+
+def mappa_periodo_originale(df_agg, map_tile):
+    # Popup dell'analisi di periodo prima del modello condiviso: una figura, un to_html e un IFrame per stazione
+    mappa = app.create_map(map_tile, location=[df_agg['LONGITUDINE'].mean(), df_agg['LATITUDINE'].mean()])
+    min_rain, max_rain = df_agg['TOTALE_PIOGGIA_GIORNO'].min(), df_agg['TOTALE_PIOGGIA_GIORNO'].max()
+    colormap = app.linear.YlGnBu_09.scale(vmin=min_rain, vmax=max_rain if max_rain > min_rain else min_rain + 1)
+    for _, row in df_agg.iterrows():
+        fig = app.go.Figure(app.go.Bar(x=['Pioggia Totale'], y=[row['TOTALE_PIOGGIA_GIORNO']], marker_color='#007bff', text=[f"{row['TOTALE_PIOGGIA_GIORNO']:.1f} mm"], textposition='auto'))
+        fig.update_layout(title_text=f"<b>{row['STAZIONE']}</b>", title_font_size=14, yaxis_title="mm", width=250, height=200, margin=dict(l=40, r=20, t=40, b=20), showlegend=False)
+        html_chart = fig.to_html(full_html=False, include_plotlyjs='cdn', config={'displayModeBar': False})
+        popup = app.folium.Popup(app.folium.IFrame(html_chart, width=280, height=230), max_width=300); color = colormap(row['TOTALE_PIOGGIA_GIORNO'])
+        app.folium.CircleMarker(location=[float(row['LONGITUDINE']), float(row['LATITUDINE'])], radius=8, color=color, fill=True, fill_color=color, fill_opacity=0.7, popup=popup, tooltip=f"{row['STAZIONE']}: {row['TOTALE_PIOGGIA_GIORNO']:.1f} mm").add_to(mappa)
+    return mappa
+
+def misura(funzione, *args):
+    """Esegue la funzione e restituisce (risultato, secondi, picco di memoria in byte)."""
+    # Due esecuzioni: tracemalloc rallenta molto le allocazioni, quindi il tempo si misura senza
+    inizio = time.perf_counter(); risultato = funzione(*args); durata = time.perf_counter() - inizio
+    tracemalloc.start(); funzione(*args); _, picco = tracemalloc.get_traced_memory(); tracemalloc.stop()
+    return risultato, durata, picco
+
+def bench_parsing(args):
+    data = genera_csv(args.stazioni, args.anni * 365)
+    print(f"Sheet sintetico: {args.stazioni} stazioni x {args.anni * 365} giorni, {len(data) / 1e6:.1f} MB di CSV")
+    for nome, funzione in [("originale (str -> numeric per colonna)", parsing_originale), ("schema (parser C, decimal=',')", app.leggi_csv)]:
+        df, durata, picco = misura(funzione, data)
+        print(f"  {nome:40s} {durata:7.2f} s  picco {picco / 1e6:8.1f} MB  frame {df.memory_usage(deep=True).sum() / 1e6:8.1f} MB")
+
+def bench_mappa(args):
+    for n_stazioni in (100, 1000, 10000):
+        df_mappa = genera_frame(n_stazioni, 1)
+        for modalita in ("Classico", "GeoJSON (veloce)"):
+            inizio = time.perf_counter(); html = app.build_main_map(df_mappa, "OpenStreetMap", modalita).get_root().render(); durata = time.perf_counter() - inizio
+            print(f"  {n_stazioni:6d} stazioni  {modalita:18s} {durata:7.2f} s  HTML {len(html) / 1e6:8.2f} MB")
+
+def bench_periodo(args):
+    df = genera_frame(args.stazioni, 30)
+    df_agg = df.groupby('STAZIONE').agg({'TOTALE_PIOGGIA_GIORNO': 'sum', 'LATITUDINE': 'first', 'LONGITUDINE': 'first'}).reset_index()
+    for nome, funzione in [("originale (figura + IFrame per stazione)", mappa_periodo_originale), ("modello condiviso lato browser", app.build_period_map)]:
+        inizio = time.perf_counter(); html = funzione(df_agg, "OpenStreetMap").get_root().render(); durata = time.perf_counter() - inizio
+        print(f"  {len(df_agg)} stazioni  {nome:42s} {durata:7.3f} s  HTML {len(html) / 1e6:8.2f} MB")
+
+def bench_storico(args):
+    # Stazione con 10 anni di storia: dati inviati ai tre grafici con storia completa e con finestra + panoramica
+    df_station = genera_frame(1, 10 * 365); inizio_finestra = df_station['DATA'].max() - pd.Timedelta(days=39)
+    grafici = [(['TOTALE_PIOGGIA_GIORNO'], app.go.Bar), (['PIOGGE_RESIDUA_ZOFFOLI', 'TEMPERATURA_MEDIANA'], app.go.Scatter), (['TEMP_MAX', 'TEMP_MIN'], app.go.Scatter)]
+    for nome, completa in [("storia completa", True), ("finestra + min-max", False)]:
+        inizio = time.perf_counter(); byte = 0; punti = 0
+        for colonne, traccia in grafici:
+            df_chart = df_station if completa else app.decimate_history(df_station, colonne, inizio_finestra)
+            fig = app.go.Figure([traccia(x=df_chart['DATA'], y=df_chart[col]) for col in colonne]); byte += len(fig.to_json()); punti += len(df_chart) * len(colonne)
+        print(f"  {len(df_station)} giorni  {nome:20s} {time.perf_counter() - inizio:7.3f} s  {punti:6d} punti  JSON {byte / 1e3:8.1f} kB")
+
+def bench_memoria(args):
+    # Byte per riga di storia: frame unico con le LEGENDA_* su ogni riga contro storico compatto + stato attuale per stazione
+    df = genera_frame(args.stazioni, args.anni * 365); storico, stato = app.separa_stato_attuale(df.copy()); n = len(df)
+    print(f"Frame sintetico: {args.stazioni} stazioni x {args.anni * 365} giorni, {n} righe")
+    for nome, tabelle in [("frame unico (prima)", [df]), ("storico + stato attuale (dopo)", [storico, stato])]:
+        in_memoria = sum(t.memory_usage(deep=True).sum() for t in tabelle); serializzato = sum(len(pickle.dumps(t)) for t in tabelle)
+        print(f"  {nome:32s} {in_memoria / n:7.1f} B/riga in memoria  {serializzato / n:7.1f} B/riga serializzato  ({in_memoria / 1e6:.1f} MB)")
+
+BENCHMARK = {"parsing": bench_parsing, "mappa": bench_mappa, "periodo": bench_periodo, "storico": bench_storico, "memoria": bench_memoria}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dei percorsi critici dell'app su dati sintetici.")
+    parser.add_argument("benchmark", nargs="*", help=f"benchmark da eseguire tra {', '.join(BENCHMARK)} (default: tutti)")
+    parser.add_argument("--stazioni", type=int, default=300)
+    parser.add_argument("--anni", type=int, default=5)
+    args = parser.parse_args()
+    for nome in args.benchmark:
+        if nome not in BENCHMARK: parser.error(f"benchmark sconosciuto: {nome}")
+    for nome in args.benchmark or list(BENCHMARK):
+        print(f"== {nome} =="); BENCHMARK[nome](args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Pre-rendering delle mappe con i filtri predefiniti: mappa riepilogativa e analisi di periodo standard per ogni tipo di mappa.
+# L'app serve questi file statici al posto del build folium finché il manifest corrisponde ai dati caricati.
+# Uso: python prerender.py [--output mappe_statiche] [--processi 4]
+# Job notturno (cron), dopo l'aggiornamento dello sheet:  30 2 * * *  cd /percorso/app && python prerender.py
+import argparse
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import app
+
+def scrivi(cartella, nome, contenuto):
+    # Scrittura atomica: l'app non legge mai un file a metà. Temporaneo con nome univoco come in app.salva_archivio,
+    # così due esecuzioni sovrapposte (cron e lancio manuale) non scrivono nello stesso file
+    fd, tmp_path = tempfile.mkstemp(dir=cartella, prefix=f"{nome}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f: f.write(contenuto)
+        os.chmod(tmp_path, 0o644); os.replace(tmp_path, os.path.join(cartella, nome))
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+# Dati comuni a tutte le mappe, passati a ogni processo una volta sola all'avvio invece che a ogni mappa
+DATI_RENDER = {}
+
+def inizializza_render(output, df_mappa, features, periodi):
+    DATI_RENDER.update(output=output, df_mappa=df_mappa, features=features, periodi=periodi)
+
+def render_mappa(tipo, tile, giorni=None):
+    """Costruisce, renderizza e scrive una mappa pre-renderizzata; restituisce il nome del file."""
+    if tipo == "riepilogo": mappa = app.build_main_map(DATI_RENDER["df_mappa"], tile, features=DATI_RENDER["features"])
+    else: mappa = app.build_period_map(DATI_RENDER["periodi"][giorni], tile)
+    nome = app.prerender_name(tipo, tile, giorni); scrivi(DATI_RENDER["output"], nome, app.render_map_html(mappa))
+    return nome
+
+def carica_dati(source, store_path):
+    # L'archivio dell'app si legge e si completa con le righe nuove dello sheet, ma non si riscrive: lo aggiorna solo l'app
+    try: dati = app.aggiorna_archivio(app.leggi_sorgente(source), store_path, sola_lettura=True)
+    except Exception as e:
+        dati = app.leggi_archivio(store_path)
+        if dati is None: raise SystemExit(f"Dati non disponibili, nessuna mappa generata: {e}")
+        print(f"Sheet non raggiungibile, uso l'archivio locale: {e}")
+    dati[0].attrs['last_loaded'] = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    return dati
+
+def prerender(source, store_path, output, processi):
+    storico, stato = carica_dati(source, store_path); versione = storico.attrs['last_loaded']
+    os.makedirs(output, exist_ok=True)
+
+    # Mappa riepilogativa: le stesse stazioni che display_main_map mostra con tutti gli slider a fondo scala. Le feature
+    # si costruiscono una volta sola qui e servono a tutti i tile
+    motore = app.get_filter_engine(versione, len(stato), stato)
+    df_mappa = stato.iloc[app.apply_filters(motore, {colonna: (0.0, limite) for colonna, limite in motore["limiti"].items()})]
+    features = app.build_station_features(df_mappa)
+    scrivi(output, "riepilogo.geojson", json.dumps(features[0], ensure_ascii=False))
+
+    # Analisi di periodo: ultimi N giorni fino all'ultima data, solo stazioni con pioggia come in display_period_analysis
+    cubo = app.get_period_cube(versione, len(storico), storico); periodi = {}
+    for giorni in app.PRERENDER_PERIOD_DAYS:
+        df_agg = app.aggregate_period(cubo, cubo["ultima_data"] - timedelta(days=giorni - 1), cubo["ultima_data"])
+        df_agg = df_agg[df_agg['TOTALE_PIOGGIA_GIORNO'] > 0]
+        if not df_agg.empty: periodi[giorni] = df_agg  # se vuoto l'app mostra solo un avviso, non una mappa
+
+    # Costruzione e serializzazione delle mappe, una per job: è la parte lenta ed è indipendente tra le mappe
+    lavori = [("riepilogo", tile, None) for tile in app.MAP_TILES] + [("periodo", tile, giorni) for giorni in periodi for tile in app.MAP_TILES]
+    if processi <= 1:
+        inizializza_render(output, df_mappa, features, periodi); mappe = [render_mappa(*lavoro) for lavoro in lavori]
+    else:
+        with ProcessPoolExecutor(max_workers=min(processi, len(lavori)), initializer=inizializza_render, initargs=(output, df_mappa, features, periodi)) as pool:
+            mappe = list(pool.map(render_mappa, *zip(*lavori)))
+
+    # Il manifest si scrive per ultimo: finché non cambia, l'app continua a servire i file della notte precedente
+    manifest = {"firma": app.prerender_signature(stato), "generato": datetime.now().strftime("%d/%m/%Y %H:%M:%S"), "stazioni": len(df_mappa), "mappe": mappe}
+    scrivi(output, "manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-renderizza le mappe dell'app con i filtri predefiniti.")
+    parser.add_argument("--sorgente", default=app.SHEET_URL, help="URL o file CSV dello sheet (default: SHEET_URL)")
+    parser.add_argument("--archivio", default=app.LOCAL_STORE_PATH, help="archivio parquet dell'app, letto senza modificarlo (default: LOCAL_STORE_PATH)")
+    parser.add_argument("--output", default=app.PRERENDER_DIR, help="cartella delle mappe statiche (default: PRERENDER_DIR)")
+    parser.add_argument("--processi", type=int, default=os.cpu_count() or 1, help="processi per il rendering delle mappe")
+    args = parser.parse_args()
+    manifest = prerender(args.sorgente, args.archivio, args.output, max(args.processi, 1))
+    print(f"{len(manifest['mappe'])} mappe generate in {args.output} per i dati {manifest['firma']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+# I test importano app.py e benchmark.py dalla radice del repository anche lanciando pytest da un'altra cartella
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
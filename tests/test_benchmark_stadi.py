@@ -0,0 +1,73 @@
+# Benchmark delle fasi dell'app (le stesse misurate da profile_stage nel pannello admin) su sheet sintetici, senza rete né browser.
+# Dimensioni (stazioni x giorni) configurabili: BENCHMARK_SHEET="300x365,1000x730" python -m pytest tests/test_benchmark_stadi.py
+# Prima del deploy, contro i risultati salvati dalla versione in produzione:
+#   python -m pytest tests/test_benchmark_stadi.py --benchmark-autosave                     (sulla versione di riferimento)
+#   python -m pytest tests/test_benchmark_stadi.py --benchmark-compare --benchmark-compare-fail=mean:25%
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import app
+import benchmark as sintetico
+
+DIMENSIONI = [tuple(int(n) for n in voce.split("x")) for voce in os.environ.get("BENCHMARK_SHEET", "50x90,300x365").split(",")]
+
+@pytest.fixture(scope="module", params=DIMENSIONI, ids=[f"{s}x{g}" for s, g in DIMENSIONI])
+def genera_csv(request):
+    # CSV nel formato dello sheet pubblicato, generato una volta per dimensione
+    return sintetico.genera_csv(*request.param)
+
+@pytest.fixture(scope="module")
+def dati(genera_csv, tmp_path_factory):
+    storico, stato = app.aggiorna_archivio(genera_csv, str(tmp_path_factory.mktemp("archivio") / "benchmark.parquet"))
+    storico.attrs['last_loaded'] = f"benchmark {len(storico)}"
+    return storico, stato
+
+@pytest.fixture(scope="module")
+def df_mappa(dati):
+    motore = app.get_filter_engine.__wrapped__("benchmark", len(dati[1]), dati[1])
+    return dati[1].iloc[app.apply_filters(motore, {colonna: (0.0, limite) for colonna, limite in motore["limiti"].items()})]
+
+@pytest.fixture(scope="module")
+def df_agg(dati):
+    cubo = app.get_period_cube.__wrapped__("benchmark", len(dati[0]), dati[0])
+    df_agg = app.aggregate_period(cubo, cubo["ultima_data"] - pd.Timedelta(days=29), cubo["ultima_data"])
+    return df_agg[df_agg['TOTALE_PIOGGIA_GIORNO'] > 0]
+
+def test_parsing(benchmark, genera_csv, tmp_path):
+    # Primo caricamento: parsing completo dello sheet e scrittura dell'archivio
+    archivio = str(tmp_path / "benchmark.parquet")
+    def carica():
+        for parte in (archivio, app.percorso_parte(archivio, "coda"), app.percorso_parte(archivio, "stato")):
+            if os.path.exists(parte): os.remove(parte)
+        return app.aggiorna_archivio(genera_csv, archivio)
+    storico, stato = benchmark.pedantic(carica, rounds=3)
+    assert len(stato) and len(storico) >= len(stato)
+
+def test_filtri(benchmark, dati):
+    motore = app.get_filter_engine.__wrapped__("benchmark", len(dati[1]), dati[1])
+    selezioni = {colonna: (0.0, limite / 2) for colonna, limite in motore["limiti"].items()}
+    benchmark(app.apply_filters, motore, selezioni)
+
+@pytest.mark.parametrize("modalita", ["GeoJSON (veloce)", "Classico"])
+def test_mappa_riepilogo(benchmark, df_mappa, modalita):
+    html = benchmark.pedantic(lambda: app.render_map_html(app.build_main_map(df_mappa, "OpenStreetMap", modalita)), rounds=3)
+    assert "leaflet" in html
+
+def test_cubo_periodo(benchmark, dati):
+    benchmark.pedantic(app.get_period_cube.__wrapped__, args=("benchmark", len(dati[0]), dati[0]), rounds=3)
+
+def test_mappa_periodo(benchmark, df_agg):
+    html = benchmark.pedantic(lambda: app.render_map_html(app.build_period_map(df_agg, "OpenStreetMap")), rounds=3)
+    assert "Plotly" in html
+
+def test_storico_stazione(benchmark, dati):
+    storico = dati[0]; stazione = storico['STAZIONE'].iloc[-1]
+    inizio_finestra = storico['DATA'].max() - pd.Timedelta(days=39)
+    def grafici():
+        df_station = app.get_station_history(storico, stazione)
+        return [app.decimate_history(df_station, colonne, inizio_finestra) for colonne in (['TOTALE_PIOGGIA_GIORNO'], ['PIOGGE_RESIDUA_ZOFFOLI', 'TEMPERATURA_MEDIANA'], ['TEMP_MAX', 'TEMP_MIN'])]
+    benchmark(grafici)
@@ -0,0 +1,13 @@
+# Conversione delle date dello sheet: valori distinti convertiti una volta e ridistribuiti, celle vuote a NaT
+import pandas as pd
+
+import app
+
+def test_converti_date():
+    serie = pd.Series(["10/10/2025", None, "01/02/2024", "10/10/2025", "non è una data"], dtype="str")
+    assert app.converti_date(serie).tolist() == [pd.Timestamp("2025-10-10"), pd.NaT, pd.Timestamp("2024-02-01"), pd.Timestamp("2025-10-10"), pd.NaT]
+
+def test_converti_date_colonna_vuota():
+    # Sbalzo senza eventi in tutto lo sheet: nessun valore da convertire
+    assert app.converti_date(pd.Series([None, None], dtype="str"), formato="%d/%m/%Y").isna().all()
+    assert app.converti_date(pd.Series([], dtype="str")).empty
@@ -0,0 +1,29 @@
+# HTML dei popup confrontato con un file di riferimento: qualsiasi ottimizzazione di build_popup_html deve produrre gli stessi byte
+import os
+
+import pandas as pd
+import pytest
+
+import app
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+@pytest.fixture(scope="module")
+def stato():
+    # Piccolo sheet nel formato pubblicato, letto con lo stesso percorso dell'app: negativi, celle vuote, testo bianco,
+    # migliaia e milioni, mezzi centesimi (4,075 e 1234567,891 arrotondano diversamente in float32), un gruppo del popup
+    # tutto vuoto e un comune con virgole e virgolette
+    with open(os.path.join(FIXTURES, "popup_snapshot.csv"), "rb") as f: data = f.read()
+    return app.separa_stato_attuale(app.prepara_righe(app.leggi_csv(data)))[1]
+
+def test_popup_uguale_al_riferimento(stato):
+    # Una riga del file per stazione; per rigenerarlo dopo una modifica voluta del popup:
+    # open("tests/fixtures/popup_golden.html", "w", encoding="utf-8", newline="").write("\n".join(app.build_popup_html(stato)) + "\n")
+    with open(os.path.join(FIXTURES, "popup_golden.html"), encoding="utf-8", newline="") as f: riferimento = f.read().split("\n")[:-1]
+    assert list(app.build_popup_html(stato)) == riferimento
+
+def test_formato_valori():
+    serie = pd.Series([-1234.5, 0.005, 999.999, 1000.0, 1234567.5, float("nan")], dtype="float64")
+    assert app.format_popup_values(serie).fillna("NaN").tolist() == ["-1.234,50", "0,01", "1.000,00", "1.000,00", "1.234.567,50", "NaN"]
+    testo = pd.Series(["Comune 1", "   ", "", None], dtype="str")
+    assert app.format_popup_values(testo).notna().tolist() == [True, False, False, False]
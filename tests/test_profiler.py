@@ -0,0 +1,30 @@
+# Picco di memoria per fase: tracemalloc misura tutto il processo, quindi le fasi sovrapposte non devono rubarsi il picco
+import threading
+import tracemalloc
+
+import pytest
+
+import app
+
+@pytest.fixture
+def profiler():
+    tracemalloc.start(); yield app.get_profiler.__wrapped__()
+    tracemalloc.stop()
+
+def test_fase_isolata_misura_il_picco(profiler):
+    with app.profile_stage("esterna", profiler):
+        with app.profile_stage("interna", profiler): blocco = bytearray(5_000_000); del blocco
+    # La fase annidata nello stesso thread ha il suo picco; quella esterna è stata interrotta da un reset e non si registra
+    assert profiler["stadi"]["interna"]["picco_memoria_byte"] > 4_000_000
+    assert profiler["stadi"]["esterna"]["picco_memoria_byte"] is None and profiler["stadi"]["esterna"]["chiamate"] == 1
+
+def test_fasi_concorrenti_non_misurate(profiler):
+    iniziata, fine = threading.Event(), threading.Event()
+    def altra_sessione():
+        with app.profile_stage("thread", profiler): iniziata.set(); fine.wait(5)
+    thread = threading.Thread(target=altra_sessione); thread.start(); iniziata.wait(5)
+    with app.profile_stage("script", profiler): blocco = bytearray(5_000_000); del blocco
+    fine.set(); thread.join()
+    assert profiler["stadi"]["script"]["picco_memoria_byte"] is None and profiler["stadi"]["thread"]["picco_memoria_byte"] is None
+    with app.profile_stage("script", profiler): blocco = bytearray(1_000_000); del blocco
+    assert profiler["stadi"]["script"]["picco_memoria_byte"] > 800_000 and profiler["stadi"]["script"]["chiamate"] == 2
@@ -0,0 +1,76 @@
+# SheetRefresher contro un server HTTP locale che imita lo sheet pubblicato (ETag, 304, errori)
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app
+from benchmark import genera_csv
+
+class FintoSheet(BaseHTTPRequestHandler):
+    # Stato condiviso dal test: corpo e ETag correnti, codice d'errore forzato, richieste ricevute
+    corpo = b""; etag = '"v1"'; errore = None; richieste = []
+
+    def do_GET(self):
+        FintoSheet.richieste.append(self.headers.get("If-None-Match"))
+        if FintoSheet.errore: self.send_error(FintoSheet.errore); return
+        if self.headers.get("If-None-Match") == FintoSheet.etag: self.send_response(304); self.end_headers(); return
+        self.send_response(200); self.send_header("ETag", FintoSheet.etag); self.send_header("Content-Length", str(len(FintoSheet.corpo))); self.end_headers()
+        self.wfile.write(FintoSheet.corpo)
+
+    def log_message(self, *args): pass
+
+@pytest.fixture
+def sheet():
+    FintoSheet.corpo = genera_csv(n_stazioni=5, n_giorni=20); FintoSheet.etag = '"v1"'; FintoSheet.errore = None; FintoSheet.richieste = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FintoSheet)
+    thread = threading.Thread(target=server.serve_forever, daemon=True); thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/sheet.csv"
+    server.shutdown(); server.server_close()
+
+@pytest.fixture
+def elaborazioni(monkeypatch):
+    # Conta le elaborazioni del CSV: un 304 non deve arrivare fino al parser
+    chiamate = []; originale = app.aggiorna_archivio
+    def aggiorna_archivio(*args, **kwargs): chiamate.append(args); return originale(*args, **kwargs)
+    monkeypatch.setattr(app, "aggiorna_archivio", aggiorna_archivio)
+    return chiamate
+
+def test_refresh_200_pubblica_snapshot(sheet, elaborazioni, tmp_path):
+    refresher = app.SheetRefresher(sheet, str(tmp_path / "archivio.parquet"))
+    assert refresher.refresh() is True
+    storico, stato = refresher.get()
+    assert len(stato) == 5 and len(storico) == 5 * 20
+    assert refresher.etag == '"v1"' and refresher.ultimo_errore is None and len(elaborazioni) == 1
+
+def test_refresh_304_non_rielabora(sheet, elaborazioni, tmp_path):
+    refresher = app.SheetRefresher(sheet, str(tmp_path / "archivio.parquet"))
+    assert refresher.refresh() is True; snapshot = refresher.get()
+    assert refresher.refresh() is False
+    assert FintoSheet.richieste == [None, '"v1"']
+    assert len(elaborazioni) == 1 and refresher.get() is snapshot and refresher.ultimo_errore is None
+
+def test_refresh_500_mantiene_snapshot(sheet, elaborazioni, tmp_path):
+    refresher = app.SheetRefresher(sheet, str(tmp_path / "archivio.parquet"))
+    assert refresher.refresh() is True; snapshot = refresher.get()
+    FintoSheet.errore = 500; FintoSheet.etag = '"v2"'
+    assert refresher.refresh() is False
+    assert refresher.get() is snapshot and refresher.etag == '"v1"'
+    assert "500" in refresher.ultimo_errore and len(elaborazioni) == 1
+    # Tornato disponibile lo sheet, il refresh successivo pubblica di nuovo e azzera l'errore
+    FintoSheet.errore = None
+    assert refresher.refresh() is True and refresher.ultimo_errore is None and refresher.get() is not snapshot
+
+def test_backoff_senza_snapshot(tmp_path):
+    refresher = app.SheetRefresher(str(tmp_path / "manca.csv"), str(tmp_path / "archivio.parquet"), intervallo=3600, ritento=30)
+    assert refresher.refresh() is False and refresher.get() is None and refresher.ultimo_errore
+    attese = [refresher.prossima_attesa(0)]
+    for _ in range(8): attese.append(refresher.prossima_attesa(attese[-1]))
+    assert attese == [30, 60, 120, 240, 480, 960, 1920, 3600, 3600]
+
+def test_clear_della_cache_ferma_il_thread(sheet, tmp_path):
+    # Svuotando la cache delle risorse il refresher rilasciato smette di aggiornare l'archivio, invece di affiancarsi al nuovo
+    refresher = app.get_data_refresher(sheet, str(tmp_path / "archivio.parquet"))
+    assert refresher.get() is not None and refresher._thread.is_alive()
+    app.get_data_refresher.clear(); refresher._thread.join(timeout=5)
+    assert not refresher._thread.is_alive()